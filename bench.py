@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Benchmarks for the hot paths, driven by recordings made with replay.py.
+# Results can be saved as a baseline and later runs are compared against it.
+
+import argparse
+import json
+import numpy as np
+import os
+import sys
+import time
+
+import motion
+import render
+import replay
+
+from config import *
+
+class StageTimer(object):
+	def __init__(self):
+		self.frames = []
+
+	def begin(self):
+		self.current = {}
+		self.last = time.time()
+		self.frames.append(self.current)
+
+	def mark(self, stage):
+		now = time.time()
+		self.current[stage] = now - self.last
+		self.last = now
+
+	def stages(self):
+		names = []
+		for frame in self.frames:
+			for name in frame:
+				if name not in names:
+					names.append(name)
+		return names
+
+def summarize(times):
+	times = np.array(times) * 1000
+	return {
+		"mean": float(np.mean(times)),
+		"p50": float(np.percentile(times, 50)),
+		"p99": float(np.percentile(times, 99)),
+	}
+
+def bench_motion(args):
+	frames = replay.ReplayStream(args.recording, "depth").frames
+	depth_filter = np.load(args.filter) if args.filter else motion.load_depth_filter()
+	pipeline = motion.ZoneDetector(depth_filter, factory=PIPELINES[args.pipeline])
+
+	# Use the first mostly valid frame as the reference, as MotionSensor does
+	start = 0
+	while start < len(frames) - 1 and np.count_nonzero(frames[start] != 2047) < VALID_THRESHOLD:
+		start += 1
+	pipeline.reset(np.asarray(frames[start]))
+	start += 1
+	if start >= len(frames):
+		raise ValueError("Recording too short")
+
+	def run(count, timer=None):
+		pipeline.timer = timer
+		totals = []
+		for i in xrange(count):
+			frame = np.asarray(frames[start + i % (len(frames) - start)])
+			t = time.time()
+			pipeline.process(frame)
+			totals.append(time.time() - t)
+		return totals
+
+	run(args.warmup)
+	timer = StageTimer()
+	t = time.time()
+	totals = run(args.frames, timer)
+	elapsed = time.time() - t
+
+	result = summarize(totals)
+	result["fps"] = args.frames / elapsed
+	result["stages"] = dict((name, summarize([f.get(name, 0) for f in timer.frames]))
+	                        for name in timer.stages())
+	return "motion-" + args.pipeline, result
+
+def bench_render(args):
+	# Times the PIL based renderer against render.py, per stream
+	result = {"stages": {}}
+	totals = []
+	elapsed = 0
+	for kind in ("depth", "video"):
+		try:
+			frames = replay.ReplayStream(args.recording, kind).frames
+		except IOError:
+			continue
+		for impl, func in (("pil", getattr(render, "pil_render_" + kind)),
+		                   ("fast", getattr(render, "render_" + kind))):
+			for i in xrange(args.warmup):
+				func(np.asarray(frames[i % len(frames)]))
+			times = []
+			for i in xrange(args.frames):
+				frame = np.asarray(frames[i % len(frames)])
+				t = time.time()
+				func(frame)
+				times.append(time.time() - t)
+			result["stages"]["%s-%s" % (kind, impl)] = summarize(times)
+			if impl == "fast":
+				totals += times
+				elapsed += sum(times)
+	if not totals:
+		raise ValueError("Recording has no frames")
+	result.update(summarize(totals))
+	result["fps"] = len(totals) / elapsed
+	return "render", result
+
+def report(name, result, baseline):
+	def delta(new, old):
+		if not old:
+			return ""
+		return " (%+.1f%%)" % (100.0 * (new - old) / old)
+
+	base = baseline.get(name, {})
+	print "%s: %.1f frames/s%s" % (name, result["fps"], delta(result["fps"], base.get("fps")))
+	print "  %-12s %9s %9s %9s" % ("stage", "mean ms", "p50 ms", "p99 ms")
+	rows = [(s, result["stages"][s], base.get("stages", {}).get(s, {}))
+	        for s in sorted(result["stages"])]
+	rows.append(("total", result, base))
+	for stage, r, b in rows:
+		print "  %-12s %9.3f %9.3f %9.3f%s" % (stage, r["mean"], r["p50"], r["p99"],
+		                                       delta(r["p50"], b.get("p50")))
+
+PIPELINES = {
+	"reference": motion.MotionPipeline,
+	"inplace": motion.InplaceMotionPipeline,
+	"pyramid": motion.PyramidMotionPipeline,
+}
+
+BENCHMARKS = {
+	"motion": bench_motion,
+	"render": bench_render,
+}
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark kinlarm hot paths")
+	parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+	parser.add_argument("recording", help="recording directory (see replay.py)")
+	parser.add_argument("--frames", type=int, default=500, help="frames to time")
+	parser.add_argument("--warmup", type=int, default=20, help="untimed frames first")
+	parser.add_argument("--pipeline", choices=sorted(PIPELINES), default="inplace",
+	                    help="motion pipeline implementation")
+	parser.add_argument("--filter", help="depth filter (default: depth_filter.npy if present)")
+	parser.add_argument("--baseline", default="bench_baseline.json", help="baseline file")
+	parser.add_argument("--save", action="store_true", help="save results as the new baseline")
+	parser.add_argument("--tolerance", type=float, default=0.1,
+	                    help="allowed p50 slowdown vs. the baseline (fraction)")
+	args = parser.parse_args()
+
+	baseline = {}
+	if os.path.exists(args.baseline):
+		with open(args.baseline) as fd:
+			baseline = json.load(fd)
+
+	name, result = BENCHMARKS[args.benchmark](args)
+	report(name, result, baseline)
+
+	if args.save:
+		baseline[name] = result
+		with open(args.baseline, "w") as fd:
+			json.dump(baseline, fd, indent=2, sort_keys=True)
+		print "Saved baseline to %s" % args.baseline
+	elif name in baseline:
+		old = baseline[name]["p50"]
+		if result["p50"] > old * (1 + args.tolerance):
+			print "REGRESSION: p50 %.3f ms vs. baseline %.3f ms" % (result["p50"], old)
+			sys.exit(1)
@@ -1,35 +1,102 @@
 #!/usr/bin/env python
 
 import logging
+import errno
+import fcntl
+import os
+import select
 import sys
 import time
 import threading
 
 import kinectcore
 import mail
+import metrics
 import motion
+import recorder
+import render
 import sounder
 import web
 
-from freenect import LED_GREEN, LED_RED, LED_YELLOW, LED_BLINK_RED_YELLOW, LED_BLINK_GREEN
+from kinectcore import LED_GREEN, LED_RED, LED_YELLOW, LED_BLINK_RED_YELLOW, LED_BLINK_GREEN
 
 from config import *
 
+STATE_TRANSITIONS = metrics.Counter("alarm_state_transitions_total", "Entries into each state",
+                                    ["state"])
+STATE_SECONDS = metrics.Histogram("alarm_state_seconds", "Time spent in each state", ["state"],
+                                  buckets=(1, 5, 15, 30, 60, 300, 900, 3600, 14400, 86400))
+CURRENT_STATE = metrics.Gauge("alarm_state", "1 for the current state", ["state"])
+
+# Size and JPEG quality of the depth and motion images attached to alerts
+ALERT_IMAGE_SIZE = (640, 480)
+ALERT_IMAGE_QUALITY = 85
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 
+# Images attached to an alert: the depth frame and motion heat map the motion
+# sensor detected on, and a video still of that moment, as recorded or as
+# attached to the detection. Only gathered here, rendering is left to the
+# alert dispatcher thread.
+class AlertImages(object):
+	def __init__(self, detection, video=None):
+		self.detection = detection
+		self.video = video
+
+	def render(self):
+		images = []
+		detection = self.detection
+		video = self.video
+		if video is None and detection.video is not None:
+			video = render.render_video(detection.video.data, ALERT_IMAGE_SIZE, ALERT_IMAGE_QUALITY)
+		if video is not None:
+			images.append(("video.jpg", video))
+		images.append(("depth.jpg", render.render_depth(
+			detection.depth, ALERT_IMAGE_SIZE, ALERT_IMAGE_QUALITY)))
+		images.append(("motion.jpg", render.render_heatmap(
+			detection.depth, detection.motion_map, ALERT_IMAGE_SIZE, ALERT_IMAGE_QUALITY)))
+		return images
+
+	def release(self):
+		self.detection.release()
+
 class AlarmSystem(object):
 	def __init__(self):
-		self.kinect = kinectcore.KinectStreamer()
-		self.motion = motion.MotionSensor(self.kinect)
-		self.web = web.WebServer(self, self.kinect)
+		self.kinects = kinectcore.create_streamers()
+		self.motion = motion.create_sensors(self.kinects)
+		self.web = web.WebServer(self, self.kinects)
+		self.motion.on_scores = self.publish_scores
+		self.motion.on_detected = self.detected
 		self.sounder = sounder.AudioSounder()
+		self.alerts = mail.AlertDispatcher(self.alert_status)
 		self.lock = threading.Lock()
+		# Self-pipe the state machine blocks on, see wait()
+		self.wake_r, self.wake_w = os.pipe()
+		for fd in (self.wake_r, self.wake_w):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.alert_images = None
+		# Clip recorders by device, each in its own directory if there are
+		# several
+		self.recorders = {}
+		if RECORD_PATH:
+			for kinect in self.kinects:
+				path = RECORD_PATH
+				if len(self.kinects) > 1:
+					path = os.path.join(RECORD_PATH, "kinect%d" % kinect.device)
+				self.recorders[kinect.device] = recorder.ClipRecorder(kinect, path)
+		# Latest video frames while armed, for alerts from Kinects without a
+		# recorder to hold them
+		self.video_keepers = {}
+		if ALERT_IMAGES:
+			for kinect in self.kinects:
+				if kinect.device not in self.recorders:
+					self.video_keepers[kinect.device] = kinectcore.FrameKeeper(kinect, "video")
 
-		self.threads = [
-			self.kinect,
+		self.threads = self.kinects + [
 			self.motion,
-			self.web
-		]
+			self.web,
+			self.alerts
+		] + self.recorders.values() + self.video_keepers.values()
 
 		self.states = [
 			"disarmed", "arming", "armed", "prealarm", "notify", "alarm", "silenced"
@@ -46,96 +113,204 @@ class AlarmSystem(object):
 						thread.stop()
 				except:
 					logging.exception("Exception while stopping thread")
+			# Lets motion worker processes save their model before exiting
+			self.motion.close()
 
 	def body(self):
-		self.kinect.start()
+		for kinect in self.kinects:
+			kinect.start()
 		self.web.start()
+		self.alerts.start()
+		for clip_recorder in self.recorders.values():
+			clip_recorder.start()
 
 		self.state = self.disarmed
 		self.new_state = None
 		while True:
-			self.state = self.state()
+			name = self.state.__name__
+			self.web.events.publish("state", name.title())
+			STATE_TRANSITIONS.labels(name).inc()
+			CURRENT_STATE.labels(name).set(1)
+			entered = time.time()
+			self.sensor_mode(self.state)
+			try:
+				self.state = self.state()
+			finally:
+				CURRENT_STATE.labels(name).set(0)
+				STATE_SECONDS.labels(name).observe(time.time() - entered)
 			with self.lock:
 				if self.new_state:
 					self.state = self.new_state
 					self.new_state = None
 
-	def disarmed(self):
-		logging.info("State: DISARMED")
-		self.kinect.set_led(LED_GREEN)
+	# Wakes the state machine up to look at its inputs again. Safe to call
+	# from any thread.
+	def wake(self):
+		try:
+			os.write(self.wake_w, "x")
+		except OSError as e:
+			# A full pipe already holds a wakeup
+			if e.errno != errno.EAGAIN:
+				raise
+
+	# Waits for a requested state switch ("switch"), detected motion
+	# ("motion", if watching for it), until() becoming true ("until", checked
+	# on every wakeup) or the timeout ("timeout"). select() returns as soon as
+	# a wakeup is posted, and unlike an untimed Queue.get() it can be
+	# interrupted by Ctrl-C. The pipe is drained before looking at the inputs,
+	# so a wakeup posted after that is never missed.
+	def wait(self, timeout=None, motion=False, until=None):
+		deadline = None
+		if timeout is not None:
+			deadline = time.time() + timeout
 		while True:
-			time.sleep(1)
+			try:
+				while os.read(self.wake_r, 4096):
+					pass
+			except OSError as e:
+				if e.errno != errno.EAGAIN:
+					raise
 			if self.new_state:
-				return
+				return "switch"
+			if motion and self.motion.detected.is_set():
+				return "motion"
+			if until is not None and until():
+				return "until"
+			remaining = None
+			if deadline is not None:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return "timeout"
+			try:
+				select.select([self.wake_r], [], [], remaining)
+			except select.error as e:
+				if e.args[0] != errno.EINTR:
+					raise
+
+	# Runs motion detection while armed, and keeps the reference model up to
+	# date in the states leading up to it if configured to. Video frames are
+	# kept at hand from arming on, for the alert images.
+	def sensor_mode(self, state):
+		if state == self.armed:
+			self.motion.start()
+		elif state == self.arming and (MOTION_WARM_ARMING or MOTION_WARM_DISARMED):
+			# Learn from every frame, so that the model converges before
+			# ARM_TIME is up
+			self.motion.warm(1)
+		elif state == self.disarmed and MOTION_WARM_DISARMED:
+			self.motion.warm()
+		else:
+			self.motion.stop()
+		for keeper in self.video_keepers.values():
+			if state in (self.arming, self.armed):
+				keeper.start()
+			else:
+				keeper.stop()
+
+	def disarmed(self):
+		logging.info("State: DISARMED")
+		self.set_led(LED_GREEN)
+		self.wait()
 
 	def arming(self):
 		logging.info("State: ARMING")
-		self.kinect.set_led(LED_BLINK_GREEN)
-		for i in range(ARM_TIME):
-			time.sleep(1)
-			if self.new_state:
-				return
-		return self.armed
+		self.set_led(LED_BLINK_GREEN)
+		if self.wait(ARM_TIME) == "timeout":
+			return self.armed
 
 	def armed(self):
 		logging.info("State: ARMED")
-		self.kinect.set_led(LED_YELLOW)
-		self.motion.start()
-		try:
-			self.motion.detected.clear()
-
-			while True:
-				time.sleep(1)
-				if self.motion.detected.is_set():
-					return self.prealarm
-				if self.new_state:
-					return
-		finally:
-			self.motion.stop()
+		self.set_led(LED_YELLOW)
+		if self.wait(motion=True) == "motion":
+			return self.prealarm
 
 	def prealarm(self):
 		logging.info("State: PREALARM")
-		self.kinect.set_led(LED_BLINK_RED_YELLOW)
-		for i in range(PREALARM_GRACE):
-			time.sleep(1)
-			if self.new_state:
-				return
-		return self.notify
+		self.set_led(LED_BLINK_RED_YELLOW)
+		self.record_clip("prealarm")
+		# Have the mail connection ready in case this turns into an alert
+		self.alerts.prepare()
+		images = self.capture_images()
+		if self.wait(PREALARM_GRACE) == "timeout":
+			self.alert_images = images
+			return self.notify
+		if images is not None:
+			images.release()
 
 	def notify(self):
 		logging.warning("State: NOTIFY")
-		self.kinect.set_led(LED_RED)
-		try:
-			mail.send_alert("Motion detected")
-		except:
-			logging.exception("Alert failed!")
-			return self.alarm
+		self.set_led(LED_RED)
+		images, self.alert_images = self.alert_images, None
+		alert = self.alerts.send("Motion detected", images)
 
-		for i in range(NOTIFY_TIMEOUT):
-			time.sleep(1)
-			if self.new_state:
-				return
-		return self.alarm
+		# Sound the alarm right away if the alert can't be delivered
+		result = self.wait(NOTIFY_TIMEOUT, until=alert.failed)
+		if result == "until":
+			logging.error("Alert failed!")
+		if result != "switch":
+			return self.alarm
 
 	def alarm(self):
 		logging.warning("State: ALARM")
-		self.kinect.set_led(LED_RED)
+		self.set_led(LED_RED)
+		self.record_clip("alarm")
 		self.sounder.activate()
 		try:
-			while True:
-				time.sleep(1)
-				if self.new_state:
-					return
+			self.wait()
 		finally:
 			self.sounder.deactivate()
 
 	def silenced(self):
 		logging.warning("State: SILENCED")
-		self.kinect.set_led(LED_RED)
-		while True:
-			time.sleep(1)
-			if self.new_state:
-				return
+		self.set_led(LED_RED)
+		self.wait()
+
+	def set_led(self, ledstate):
+		for kinect in self.kinects:
+			kinect.set_led(ledstate)
+
+	def record_clip(self, reason):
+		for clip_recorder in self.recorders.values():
+			clip_recorder.trigger(reason)
+
+	# Called by the motion sensors right after detecting motion, to attach
+	# the video frame of that moment
+	def detected(self):
+		detection = self.motion.detection
+		keeper = detection and self.video_keepers.get(detection.device)
+		if keeper:
+			detection.video = keeper.latest()
+		self.wake()
+
+	# Takes what the motion sensor saw, and the recorded video frame closest
+	# to it, which the recorder would have dropped by the time the alert
+	# goes out
+	def capture_images(self):
+		detection, self.motion.detection = self.motion.detection, None
+		if detection is None:
+			return None
+		if not ALERT_IMAGES:
+			detection.release()
+			return None
+		video = None
+		clip_recorder = self.recorders.get(detection.device)
+		if clip_recorder:
+			frame = clip_recorder.nearest("video", detection.time)
+			if frame is not None:
+				video = frame[2]
+		return AlertImages(detection, video)
+
+	# Called from the alert dispatcher
+	def alert_status(self, alert):
+		self.web.events.publish("alert", {
+			"id": alert.id, "subject": alert.subject, "status": alert.status,
+			"attempts": alert.attempts, "error": alert.error})
+		self.wake()
+
+	def publish_scores(self, device, scores):
+		self.web.events.publish("motion", {"device": device, "zones": [
+			{"zone": name, "motion": motion, "lost": lost_count}
+			for name, motion, lost_count in scores]}, key="motion-%d" % device)
 
 	def switch_state(self, new_state):
 		with self.lock:
@@ -144,11 +319,16 @@ class AlarmSystem(object):
 				return
 			else:
 				self.new_state = statefunc
+		self.wake()
 
 	def stop(self):
+		for clip_recorder in self.recorders.values():
+			clip_recorder.stop()
+		self.alerts.stop()
 		self.web.stop()
-		self.motion.stop()
-		self.kinect.stop()
+		self.motion.close()
+		for kinect in self.kinects:
+			kinect.stop()
 
 if __name__ == "__main__":
 	system = AlarmSystem()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+# Compact file format for recorded 11-bit depth streams. Values above 2047
+# are stored as 2047 (invalid).
+#
+# Each frame is stored as the difference to the previous frame, modulo 2048,
+# with every KEYFRAME_INTERVAL-th frame stored as is. The 11-bit values are
+# packed, 8 values to 11 bytes, and compressed with zlib at level 1. Static
+# scenes turn into long runs of zeros, which compress very well.
+#
+# Layout: a header, then one record per frame (record header and payload),
+# then an index with the offset, receive time, device timestamp and keyframe
+# flag of each frame, and a trailer pointing at the index. If the file was
+# not closed properly, the index is rebuilt by scanning the records.
+
+import numpy as np
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = "KDPK0001"
+INDEX_MAGIC = "KDPKINDX"
+# magic, width, height, keyframe interval
+HEADER = struct.Struct("<8sHHH")
+# payload length, receive time, device timestamp, flags
+RECORD = struct.Struct("<IdIB")
+# index offset, index magic
+TRAILER = struct.Struct("<Q8s")
+KEYFRAME = 1
+
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("time", "<f8"), ("timestamp", "<u4"), ("key", "u1")])
+
+DEPTH_SHAPE = (480, 640)
+KEYFRAME_INTERVAL = 30
+VALUE_MASK = 0x7ff
+ZLIB_LEVEL = 1
+
+FILENAME = "depth.dpk"
+
+# numpy shifts of uint64 arrays need uint64 operands
+_U64 = dict((n, np.uint64(n)) for n in (11, 20, 22, 33, 44))
+_SHIFTS = [np.uint64(11 * i) for i in range(4)]
+_MASK11 = np.uint64(VALUE_MASK)
+_MASK44 = np.uint64((1 << 44) - 1)
+
+def _join44(groups):
+	return (groups[:, 0] | groups[:, 1] << _U64[11] |
+	        groups[:, 2] << _U64[22] | groups[:, 3] << _U64[33])
+
+def pack11(values):
+	# Packs groups of 8 11-bit values into 11 bytes: the first 4 values form
+	# the low 44 bits and the last 4 the high 44 bits of an 88-bit word
+	groups = values.reshape(-1, 8).astype(np.uint64)
+	lo = _join44(groups[:, :4])
+	hi = _join44(groups[:, 4:])
+	out = np.empty((len(groups), 11), np.uint8)
+	out[:, :8] = (lo | hi << _U64[44]).astype("<u8").view(np.uint8).reshape(-1, 8)
+	out[:, 8:] = (hi >> _U64[20]).astype("<u4").view(np.uint8).reshape(-1, 4)[:, :3]
+	return out.tostring()
+
+def unpack11(data, count, out=None):
+	packed = np.frombuffer(data, np.uint8).reshape(-1, 11)
+	word = packed[:, :8].copy().view("<u8")[:, 0]
+	top = np.zeros((len(packed), 4), np.uint8)
+	top[:, :3] = packed[:, 8:]
+	lo = word & _MASK44
+	hi = word >> _U64[44] | top.view("<u4")[:, 0].astype(np.uint64) << _U64[20]
+	if out is None:
+		out = np.empty(count, np.uint16)
+	groups = out.reshape(-1, 8)
+	for i, shift in enumerate(_SHIFTS):
+		groups[:, i] = (lo >> shift) & _MASK11
+		groups[:, i + 4] = (hi >> shift) & _MASK11
+	return out
+
+class DepthWriter(object):
+	def __init__(self, path, shape=DEPTH_SHAPE, keyframe_interval=KEYFRAME_INTERVAL):
+		if (shape[0] * shape[1]) % 8:
+			raise ValueError("Frame size must be a multiple of 8 pixels")
+		self.fd = open(path, "wb")
+		self.shape = tuple(shape)
+		self.keyframe_interval = keyframe_interval
+		self.fd.write(HEADER.pack(MAGIC, shape[1], shape[0], keyframe_interval))
+		self.prev = np.zeros(shape, np.uint16)
+		self.clamped = np.empty(shape, np.uint16)
+		self.delta = np.empty(shape, np.uint16)
+		self.index = []
+
+	def __len__(self):
+		return len(self.index)
+
+	def write(self, frame, time=0, timestamp=0):
+		# Values over 11 bits are invalid readings anyway, keep them invalid
+		np.minimum(frame, VALUE_MASK, self.clamped)
+		key = len(self.index) % self.keyframe_interval == 0
+		if key:
+			self.delta[...] = self.clamped
+		else:
+			np.subtract(self.clamped, self.prev, self.delta)
+			np.bitwise_and(self.delta, VALUE_MASK, self.delta)
+		self.prev, self.clamped = self.clamped, self.prev
+		payload = zlib.compress(pack11(self.delta), ZLIB_LEVEL)
+		flags = KEYFRAME if key else 0
+		self.index.append((self.fd.tell(), time, timestamp, flags))
+		self.fd.write(RECORD.pack(len(payload), time, timestamp, flags))
+		self.fd.write(payload)
+
+	def close(self):
+		if self.fd is None:
+			return
+		offset = self.fd.tell()
+		self.fd.write(np.array(self.index, INDEX_DTYPE).tostring())
+		self.fd.write(TRAILER.pack(offset, INDEX_MAGIC))
+		self.fd.close()
+		self.fd = None
+
+# Random access reader. Frames are decoded from the nearest keyframe at or
+# before the one requested, or from the last decoded frame when reading
+# forward. Frames returned by indexing are only valid until the next read;
+# read(n, out) decodes into a caller provided array instead.
+class DepthReader(object):
+	def __init__(self, path):
+		self.fd = open(path, "rb")
+		magic, width, height, self.keyframe_interval = HEADER.unpack(self.fd.read(HEADER.size))
+		if magic != MAGIC:
+			raise IOError("%s is not a depth recording" % path)
+		self.shape = (height, width)
+		self.index = self._load_index()
+		self.times = self.index["time"]
+		self.timestamps = self.index["timestamp"]
+		self.keyframes = np.flatnonzero(self.index["key"])
+		self.current = np.zeros(self.shape, np.uint16)
+		self.delta = np.empty(self.shape, np.uint16)
+		self.pos = None
+
+	def _load_index(self):
+		self.fd.seek(0, os.SEEK_END)
+		end = self.fd.tell()
+		if end >= HEADER.size + TRAILER.size:
+			self.fd.seek(end - TRAILER.size)
+			offset, magic = TRAILER.unpack(self.fd.read(TRAILER.size))
+			if magic == INDEX_MAGIC:
+				self.fd.seek(offset)
+				return np.frombuffer(self.fd.read(end - TRAILER.size - offset), INDEX_DTYPE)
+		return self._scan(end)
+
+	def _scan(self, end):
+		# No index, the recording was interrupted: walk the records, ignoring
+		# a truncated last one
+		index = []
+		offset = HEADER.size
+		while offset + RECORD.size <= end:
+			self.fd.seek(offset)
+			length, time, timestamp, flags = RECORD.unpack(self.fd.read(RECORD.size))
+			if offset + RECORD.size + length > end:
+				break
+			index.append((offset, time, timestamp, flags))
+			offset += RECORD.size + length
+		return np.array(index, INDEX_DTYPE)
+
+	def __len__(self):
+		return len(self.index)
+
+	# Number of the last frame received at or before time t
+	def frame_at(self, t):
+		return max(0, np.searchsorted(self.times, t, "right") - 1)
+
+	def _decode(self, n):
+		self.fd.seek(int(self.index["offset"][n]))
+		length, time, timestamp, flags = RECORD.unpack(self.fd.read(RECORD.size))
+		unpack11(zlib.decompress(self.fd.read(length)), self.delta.size, self.delta.reshape(-1))
+		if flags & KEYFRAME:
+			self.current[...] = self.delta
+		else:
+			np.add(self.current, self.delta, self.current)
+			np.bitwise_and(self.current, VALUE_MASK, self.current)
+		self.pos = n
+
+	def read(self, n, out=None):
+		if not 0 <= n < len(self.index):
+			raise IndexError("frame %d out of range" % n)
+		key = self.keyframes[np.searchsorted(self.keyframes, n, "right") - 1]
+		if self.pos is not None and key <= self.pos <= n:
+			start = self.pos + 1
+		else:
+			start = key
+		for i in xrange(start, n + 1):
+			self._decode(i)
+		if out is None:
+			return self.current
+		out[...] = self.current
+		return out
+
+	def __getitem__(self, n):
+		if n < 0:
+			n += len(self.index)
+		return self.read(n)
+
+	def close(self):
+		self.fd.close()
+
+# Converts a replay.py recording's depth.npy (with depth_ts.npy, if present)
+def convert(path):
+	frames = np.load(os.path.join(path, "depth.npy"), mmap_mode="r")
+	try:
+		ts = np.load(os.path.join(path, "depth_ts.npy"))
+	except IOError:
+		ts = np.zeros((len(frames), 2))
+	writer = DepthWriter(os.path.join(path, FILENAME), frames.shape[1:])
+	try:
+		for frame, (time, timestamp) in zip(frames, ts):
+			writer.write(frame, time, timestamp)
+	finally:
+		writer.close()
+	return len(frames)
+
+if __name__ == "__main__":
+	if len(sys.argv) != 2:
+		print "Usage: %s <recording directory>" % sys.argv[0]
+		print "Converts depth.npy to %s" % FILENAME
+		sys.exit(1)
+	path = sys.argv[1]
+	count = convert(path)
+	before = os.path.getsize(os.path.join(path, "depth.npy"))
+	after = os.path.getsize(os.path.join(path, FILENAME))
+	print "Converted %d frames: %d -> %d bytes (%.1f%%)" % (count, before, after, 100.0 * after / before)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+# Lookup tables for raw 11-bit Kinect depth values. There are only 2048
+# possible inputs, so each conversion is one indexed gather per frame.
+
+import numpy as np
+
+RAW_VALUES = 2048
+
+# Raw values above this are invalid (no depth reading)
+RAW_MAX_VALID = 1070
+
+# Depth assumed for invalid pixels (m)
+INVALID_DEPTH = 5
+
+def raw_to_meters(raw):
+	return 1.0 / (raw * -0.0030711016 + 3.3309495161)
+
+_raw = np.arange(RAW_VALUES, dtype=np.float)
+
+RAW_INVALID = np.arange(RAW_VALUES) > RAW_MAX_VALID
+
+# Depth in meters, with invalid values filled in with INVALID_DEPTH
+RAW_TO_DEPTH = np.where(RAW_INVALID, INVALID_DEPTH, raw_to_meters(_raw))
+
+# Closest depth the Kinect reports (m)
+MIN_DEPTH = RAW_TO_DEPTH[0]
+
+# Single precision and uint8 variants for the in-place motion pipeline
+RAW_TO_DEPTH32 = RAW_TO_DEPTH.astype(np.float32)
+RAW_INVALID_U8 = RAW_INVALID.astype(np.uint8)
+
+# Index into DISPLAY_PALETTE for depth images
+RAW_TO_DISPLAY = np.clip(45 * raw_to_meters(np.clip(_raw, 0, 1046.31)) - 45,
+                         0, 255).astype(np.uint8)
+
+DISPLAY_PALETTE = []
+for i in range(255):
+	v = int(i* 6 * 1.0)
+	h = v >> 8
+	h = h%6
+	l = v & 0xff
+	if h == 0:
+		DISPLAY_PALETTE += (255,0,255-l)
+	elif h == 1:
+		DISPLAY_PALETTE += (255,l,0)
+	elif h == 2:
+		DISPLAY_PALETTE += (255-l,255,0)
+	elif h == 3:
+		DISPLAY_PALETTE += (0,255,l)
+	elif h == 4:
+		DISPLAY_PALETTE += (0,255-l,255)
+	elif h == 5:
+		DISPLAY_PALETTE += (l,0,255)
+DISPLAY_PALETTE += (0,0,0)
+
+del _raw
+
+# Display colors for raw values, as RGB rows
+RAW_TO_RGB = np.array(DISPLAY_PALETTE, np.uint8).reshape(-1, 3)[RAW_TO_DISPLAY]
+
+def lookup(table, frame, out=None):
+	return np.take(table, frame, axis=0, out=out, mode="clip")
@@ -1,15 +1,12 @@
 #!/usr/bin/env python
 
-import cv2
-import kinectcore
+import argparse
 import math
 import numpy as np
-from motion import frame_to_depth, depth_to_img
-
-kinect = kinectcore.KinectStreamer()
-kinect.start()
+import sys
 
-clicks = []
+import depthlut
+from motion import frame_to_depth, depth_to_img
 
 fx = 594.21
 fy = 591.04
@@ -24,91 +21,169 @@ kinect_to_world = np.matrix([
 	[-cx/fx, cy/fy,  1, b]
 ])
 
+# Depth filter value where nothing is filtered
+NO_FILTER = 100
+
 def k2w(point):
 	# Convert Kinect coordinates to world coordinates
 	x, y, z = point
 	x, y, z, w = ((x,y,z,1.0) * kinect_to_world).tolist()[0]
 	return np.array((x/w, y/w, z/w))
 
-def plane_render(plane, ray):
-	# Calculate the intersection of a plane and a line, and return the z
-	# coordinate. The line is defined as intersecting ray and 0,0,0
+def offset_plane(plane, offset=0.2):
+	# caclulate unit normal
+	normal = np.cross(plane[1] - plane[0], plane[2] - plane[0])
+	normal /= math.sqrt(sum(normal * normal))
+	# calculate offset
+	offset = offset * normal
+	# add it to the plane
+	new_plane = [p + offset for p in plane]
+	# make sure it points towards us
+	d_orig = math.sqrt(sum(plane[0] * plane[0]))
+	d_new = math.sqrt(sum(new_plane[0] * new_plane[0]))
+	if d_new > d_orig:
+		offset = -offset
+		new_plane = [p + offset for p in plane]
+	return new_plane
+
+def plane_filter(plane, shape=(480, 640)):
+	# Depth at which the ray through each pixel intersects the plane. Pixel
+	# (x, y) looks along ((x-cx)/fx, -(y-cy)/fy, 1), so for a plane n.p = d
+	# the depth is d / (n.ray); rays that miss the plane are not filtered.
 	# See http://en.wikipedia.org/wiki/Line-plane_intersection
-	(x0, y0, z0), (x1, y1, z1), (x2, y2, z2) = plane
-	(x, y, z) = ray
-	mat = np.matrix([
-		[-x, x1-x0, x2-x0],
-		[-y, y1-y0, y2-y0],
-		[-z, z1-z0, z2-z0],
-	]).getI().getT()
-	vec = np.matrix([-x0, -y0, -z0])
-	res = vec * mat
-	return res[0,0] * z
-
-try:
-	cv2.namedWindow("Depth")
-	cv2.namedWindow("Depth Filter")
-
-	def mouse(event, x, y, flags, arg):
-		if event == 4:
-			clicks.append((x,y,frame[y][x]))
-
-	cv2.setMouseCallback("Depth", mouse)
-
-	depth_filter = None
-
-	for frame in kinect.depth_stream(2):
-		depth, mask = frame_to_depth(frame)
-		masked_depth = np.ma.array(depth, mask=mask)
-		if depth_filter is not None:
-			filtered_depth = np.ma.array(depth, mask=(np.logical_or(mask, depth > depth_filter)))
-		else:
-			filtered_depth = masked_depth
-		img_gb = depth_to_img(masked_depth)
-		img_r = depth_to_img(filtered_depth)
-		img = cv2.merge((img_gb, img_gb, img_r))
-		cv2.imshow("Depth", img)
-		if depth_filter is not None:
-			cv2.imshow("Depth Filter", depth_to_img(depth_filter))
-		if cv2.waitKey(10) == 27:
-			break
-
-		if len(clicks) >= 3:
-			# map plane to real world coordinates
-			plane = map(k2w, clicks[:3])
-			print plane
-			# caclulate unit normal
-			normal = np.cross(plane[1] - plane[0], plane[2] - plane[0])
-			normal /= math.sqrt(sum(normal * normal))
-			# calculate 20cm offset
-			offset = 0.2 * normal
-			# add it to the plane
-			new_plane = [p + offset for p in plane]
-			# make sure it points towards us
-			d_orig = math.sqrt(sum(plane[0] * plane[0]))
-			d_new = math.sqrt(sum(new_plane[0] * new_plane[0]))
-			if d_new > d_orig:
-				offset = -offset
-				new_plane = [p + offset for p in plane]
-
-			depth_filter = np.zeros_like(depth)
-			h, w = depth_filter.shape
-			for y in xrange(h):
-				# calculate depth at the left and right of the scanline
-				ray0 = k2w((0, y, 500.0))
-				ray1 = k2w((w, y, 500.0))
-				z0 = 1.0/plane_render(new_plane, ray0)
-				z1 = 1.0/plane_render(new_plane, ray1)
-				for x in xrange(w):
-					t = x / float(w)
-					z = 1.0/((1-t)*z0 + t*z1)
-					if not 0 < z < 100:
-						z = 100
-					depth_filter[y][x] = z
-
-			np.save("depth_filter.npy", depth_filter)
-			print "Saved depth_filter.npy"
-			clicks = []
-
-finally:
-	kinect.stop()
+	p0, p1, p2 = plane
+	normal = np.cross(p1 - p0, p2 - p0)
+	d = np.dot(normal, p0)
+	h, w = shape
+	rx = (np.arange(w) - cx) / fx
+	ry = -(np.arange(h) - cy) / fy
+	inv_z = (normal[0] * rx[np.newaxis, :] + normal[1] * ry[:, np.newaxis] + normal[2]) / d
+	with np.errstate(divide="ignore"):
+		z = 1.0 / inv_z
+	z[~((z > 0) & (z < NO_FILTER))] = NO_FILTER
+	return z
+
+def build_filter(planes, shape=(480, 640), offset=0.2, exclude=()):
+	# Each plane is three (x, y, raw depth) Kinect points; the nearest plane
+	# wins where several overlap. Excluded (x0, y0, x1, y1) rectangles are
+	# filtered out completely.
+	depth_filter = np.empty(shape)
+	depth_filter.fill(NO_FILTER)
+	for points in planes:
+		plane = offset_plane(map(k2w, points), offset)
+		np.minimum(depth_filter, plane_filter(plane, shape), depth_filter)
+	for x0, y0, x1, y1 in exclude:
+		depth_filter[y0:y1, x0:x1] = 0
+	return depth_filter
+
+def interactive(output, device=0):
+	import cv2
+	import kinectcore
+
+	kinect = kinectcore.KinectStreamer(device=device)
+	kinect.start()
+
+	clicks = []
+
+	try:
+		cv2.namedWindow("Depth")
+		cv2.namedWindow("Depth Filter")
+
+		def mouse(event, x, y, flags, arg):
+			if event == 4:
+				clicks.append((x,y,frame[y][x]))
+
+		cv2.setMouseCallback("Depth", mouse)
+
+		depth_filter = None
+
+		for frame in kinect.depth_stream(2):
+			depth, mask = frame_to_depth(frame)
+			masked_depth = np.ma.array(depth, mask=mask)
+			if depth_filter is not None:
+				filtered_depth = np.ma.array(depth, mask=(np.logical_or(mask, depth > depth_filter)))
+			else:
+				filtered_depth = masked_depth
+			img_gb = depth_to_img(masked_depth)
+			img_r = depth_to_img(filtered_depth)
+			img = cv2.merge((img_gb, img_gb, img_r))
+			cv2.imshow("Depth", img)
+			if depth_filter is not None:
+				cv2.imshow("Depth Filter", depth_to_img(depth_filter))
+			if cv2.waitKey(10) == 27:
+				break
+
+			if len(clicks) >= 3:
+				print clicks[:3]
+				depth_filter = build_filter([clicks[:3]], depth.shape)
+				np.save(output, depth_filter)
+				print "Saved %s" % output
+				del clicks[:]
+
+	finally:
+		kinect.stop()
+
+def load_frame(path):
+	if path.endswith(".npy"):
+		frame = np.load(path, mmap_mode="r")
+		if frame.ndim == 3:
+			frame = frame[0]
+	else:
+		import replay
+		frame = replay.ReplayStream(path, "depth").frames[0]
+	return np.asarray(frame)
+
+def parse_ints(arg, count):
+	values = tuple(int(float(v)) for v in arg.split(","))
+	if len(values) not in count:
+		raise argparse.ArgumentTypeError("expected %s comma separated values: %r"
+		                                 % (" or ".join(map(str, count)), arg))
+	return values
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Generate depth_filter.npy. Without --plane, runs interactively: "
+		            "click three points on a surface in the Depth window.")
+	parser.add_argument("--plane", nargs=3, action="append", default=[],
+	                    type=lambda v: parse_ints(v, (2, 3)), metavar="X,Y[,RAW]",
+	                    help="three points on a surface, with their raw depth or taken "
+	                         "from --frame; may be repeated")
+	parser.add_argument("--frame", help="depth frame (.npy) or recording to sample points from")
+	parser.add_argument("--offset", type=float, default=0.2,
+	                    help="distance (m) of the filter in front of each surface")
+	parser.add_argument("--exclude", action="append", default=[],
+	                    type=lambda v: parse_ints(v, (4,)), metavar="X0,Y0,X1,Y1",
+	                    help="rectangle to remove from motion detection; may be repeated")
+	parser.add_argument("--device", type=int,
+	                    help="Kinect device to use interactively, and to name the output after "
+	                         "(depth_filter_<n>.npy)")
+	parser.add_argument("-o", "--output")
+	args = parser.parse_args()
+
+	if args.output is None:
+		args.output = "depth_filter.npy"
+		if args.device is not None:
+			import kinectcore
+			args.output = kinectcore.device_file(args.output, args.device)
+
+	if not args.plane and not args.exclude:
+		interactive(args.output, args.device or 0)
+		sys.exit(0)
+
+	frame = load_frame(args.frame) if args.frame else None
+	planes = []
+	for points in args.plane:
+		plane = []
+		for point in points:
+			if len(point) == 2:
+				if frame is None:
+					parser.error("--frame is required for points without a depth")
+				x, y = point
+				point = (x, y, frame[y, x])
+			if point[2] > depthlut.RAW_MAX_VALID:
+				parser.error("no depth reading at %d,%d" % point[:2])
+			plane.append(point)
+		planes.append(plane)
+
+	np.save(args.output, build_filter(planes, offset=args.offset, exclude=args.exclude))
+	print "Saved %s" % args.output
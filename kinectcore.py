@@ -1,87 +1,335 @@
 #!/usr/bin/env python
 
-import freenect
+import collections
 import logging
 import numpy as np
+import os
 import threading
+import time
 
 import debug
+import metrics
 from config import *
 
+try:
+	import freenect
+	from freenect import LED_GREEN, LED_RED, LED_YELLOW, LED_BLINK_GREEN, LED_BLINK_RED_YELLOW
+except ImportError:
+	freenect = None # No libfreenect, only recorded footage can be used
+	# Same values as freenect_led_options, replay sources ignore them
+	LED_GREEN, LED_RED, LED_YELLOW, LED_BLINK_GREEN, LED_BLINK_RED_YELLOW = 1, 2, 3, 4, 6
+
+FRAMES = metrics.Counter("kinect_frames_total", "Frames received from the Kinect",
+                         ["device", "stream"])
+CONSUMER_DROPS = metrics.Counter("kinect_consumer_dropped_total",
+                                 "Frames dropped by consumers that fell behind", ["device", "stream"])
+DISPATCH_SECONDS = metrics.Histogram("kinect_dispatch_seconds",
+                                     "Time spent handing each frame to consumers", ["device", "stream"])
+CONSUMERS = metrics.Gauge("kinect_consumers", "Open frame consumers", ["device", "stream"])
+
 class StreamerDied(Exception):
 	pass
 
-class OneQueue(object):
+class SourceExhausted(StreamerDied):
+	pass
+
+# Raised by the streamer body to make a frame source leave its runloop
+class StopRunloop(Exception):
+	pass
+
+# Raised by a consumer's next() after interrupt()
+class ConsumerStopped(Exception):
+	pass
+
+# Frame sources drive the streamer callbacks. A source must provide open(),
+# close(), start/stop_depth(), start/stop_video(), set_led() and runloop(),
+# which calls body() regularly and returns once it raises StopRunloop.
+class FreenectSource(object):
+	def __init__(self, index=0):
+		self.index = index
+
+	def open(self, depth_cb, video_cb):
+		# Each device gets its own context, run by its own streamer thread
+		self.ctx = freenect.init()
+		self.dev = freenect.open_device(self.ctx, self.index)
+
+		freenect.set_depth_mode(self.dev, freenect.RESOLUTION_MEDIUM, freenect.DEPTH_11BIT)
+		freenect.set_depth_callback(self.dev, depth_cb)
+		freenect.set_video_mode(self.dev, freenect.RESOLUTION_MEDIUM, freenect.VIDEO_RGB)
+		freenect.set_video_callback(self.dev, video_cb)
+
+	def close(self):
+		freenect.close_device(self.dev)
+		freenect.shutdown(self.ctx)
+
+	def start_depth(self):
+		freenect.start_depth(self.dev)
+	def stop_depth(self):
+		freenect.stop_depth(self.dev)
+	def start_video(self):
+		freenect.start_video(self.dev)
+	def stop_video(self):
+		freenect.stop_video(self.dev)
+
+	def set_led(self, ledstate):
+		freenect.set_led(self.dev, ledstate)
+
+	def runloop(self, body):
+		def _body(*args):
+			try:
+				body()
+			except StopRunloop:
+				raise freenect.Kill()
+		freenect.base_runloop(self.ctx, _body)
+
+# REPLAY_PATH is either one recording, for device 0, or a list of them in
+# KINECT_DEVICES order
+def default_source(device=0):
+	if REPLAY_PATH:
+		import replay
+		path = REPLAY_PATH
+		if not isinstance(path, basestring):
+			path = path[KINECT_DEVICES.index(device)]
+		return replay.ReplaySource(path, realtime=True, loop=True)
+	return FreenectSource(device)
+
+# Per-device variant of a file name: depth_filter.npy -> depth_filter_1.npy
+def device_file(path, device):
+	root, ext = os.path.splitext(path)
+	return "%s_%d%s" % (root, device, ext)
+
+# A pooled frame buffer shared read-only by all consumers of one frame. It
+# goes back to its pool once every holder has called release().
+# seq is the device frame number, timestamp the device timestamp and time
+# the time.time() at which the frame was received.
+class Frame(object):
+	def __init__(self, pool, buf):
+		self.pool = pool
+		self.buf = buf
+		self.data = buf.view()
+		self.data.flags.writeable = False
+		self.refs = 0
+		self.seq = None
+		self.timestamp = None
+		self.time = None
+
+	def acquire(self):
+		self.pool.acquire(self)
+		return self
+
+	def release(self):
+		self.pool.release(self)
+
+class FramePool(object):
 	def __init__(self):
-		self.val = None
-		self.event = threading.Event()
 		self.lock = threading.Lock()
+		self.free = []
+		self.shape = None
+		self.dtype = None
 
-	def get(self):
-		self.event.wait()
+	# Copy data into a free buffer, returning a Frame holding one reference
+	def get(self, data, seq, timestamp, time):
 		with self.lock:
-			self.event.clear()
-			if isinstance(self.val, Exception):
-				raise self.val
+			if data.shape != self.shape or data.dtype != self.dtype:
+				self.shape = data.shape
+				self.dtype = data.dtype
+				self.free = []
+			if self.free:
+				frame = self.free.pop()
 			else:
-				return self.val
+				frame = Frame(self, np.empty(self.shape, self.dtype))
+			frame.refs = 1
+		frame.buf[...] = data
+		frame.seq = seq
+		frame.timestamp = timestamp
+		frame.time = time
+		return frame
 
-	def put(self, val):
+	def acquire(self, frame):
+		with self.lock:
+			frame.refs += 1
+
+	def release(self, frame):
 		with self.lock:
-			self.event.set()
-			self.val = val
+			frame.refs -= 1
+			if frame.refs == 0 and frame.buf.shape == self.shape:
+				self.free.append(frame)
+
+def release_frame(val):
+	if isinstance(val, Frame):
+		val.release()
+
+# Holds up to size values; when full, the oldest one is dropped. A size of 1
+# always delivers the latest value. Exceptions are raised by every get().
+class FrameQueue(object):
+	def __init__(self, size=1):
+		self.size = size
+		self.items = collections.deque()
+		self.cond = threading.Condition(threading.Lock())
+		self.received = 0
+		self.dropped = 0
+
+	def get(self):
+		with self.cond:
+			while not self.items:
+				self.cond.wait()
+			val = self.items[0]
+			if isinstance(val, Exception):
+				raise val
+			return self.items.popleft()
+
+	# Returns the number of frames dropped to make room
+	def put(self, val):
+		with self.cond:
+			if isinstance(val, Exception):
+				dropped = list(self.items)
+				self.items.clear()
+			else:
+				dropped = []
+				self.received += 1
+				if len(self.items) >= self.size:
+					dropped.append(self.items.popleft())
+					self.dropped += 1
+			self.items.append(val)
+			self.cond.notify()
+		for old in dropped:
+			release_frame(old)
+		return len(dropped)
+
+	def clear(self):
+		with self.cond:
+			dropped = list(self.items)
+			self.items.clear()
+		for old in dropped:
+			release_frame(old)
 
+	def __len__(self):
+		return len(self.items)
+
+# Frames returned by next() are read-only and only valid until the next call
+# to next() or stop(); consumers that keep one around must copy it. The
+# next_frame() variant returns the Frame with its metadata.
 class KinectConsumer(object):
-	def __init__(self, remove):
+	def __init__(self, remove, queue_size=1):
 		self.remove = remove
-		self.queue = OneQueue()
+		self.queue = FrameQueue(queue_size)
 		self.active = True
+		self.current = None
+		self.delivered = 0
+		self.last_seq = None
+		self.latency = None
 
 	def __iter__(self):
 		return self
 	def next(self):
-		return self.queue.get()
+		return self.next_frame().data
+
+	def next_frame(self):
+		self._release()
+		self.current = self.queue.get()
+		self.delivered += 1
+		self.last_seq = self.current.seq
+		self.latency = time.time() - self.current.time
+		return self.current
+
+	@property
+	def dropped(self):
+		return self.queue.dropped
+
+	# Frames waiting to be picked up
+	@property
+	def lag(self):
+		return len(self.queue)
+
+	def stats(self):
+		return {
+			"received": self.queue.received,
+			"delivered": self.delivered,
+			"dropped": self.queue.dropped,
+			"lag": len(self.queue),
+			"last_seq": self.last_seq,
+			"latency": self.latency,
+		}
+
+	def _release(self):
+		current, self.current = self.current, None
+		release_frame(current)
+
+	# Makes a blocked (or the next) call to next() raise ConsumerStopped, so
+	# that another thread can stop the consumer's reader promptly
+	def interrupt(self):
+		self.queue.put(ConsumerStopped())
 
 	def stop(self):
 		if self.active:
 			self.remove(self.queue)
 			self.active = False
+			self._release()
+			self.queue.clear()
 	def __del__(self):
 		self.stop()
 
 class KinectStreamer(threading.Thread):
-	def __init__(self):
-		threading.Thread.__init__(self, name="KinectStreamer")
+	def __init__(self, source=None, device=0):
+		threading.Thread.__init__(self, name="KinectStreamer-%d" % device)
+		if source is None:
+			source = default_source(device)
+		self.source = source
+		self.device = device
 		self.video_consumers = {}
 		self.depth_consumers = {}
 		self.video_frame = 0
 		self.depth_frame = 0
+		self.video_pool = FramePool()
+		self.depth_pool = FramePool()
+		self.video_metrics = self._stream_metrics(device, "video", self.video_consumers)
+		self.depth_metrics = self._stream_metrics(device, "depth", self.depth_consumers)
 		self.lock = threading.RLock()
 		self.update_cond = threading.Condition(self.lock)
 		self.update = threading.Event()
 		self.led_update = None
 		self.keep_running = True
 
-	def _video_cb(self, dev, data, timestamp):
-		if INVERT_KINECT:
-			data = data[::-1, ::-1] # Flip upside down
+	@staticmethod
+	def _stream_metrics(device, stream, consumers):
+		CONSUMERS.labels(device, stream).set_function(lambda: len(consumers))
+		return (FRAMES.labels(device, stream), CONSUMER_DROPS.labels(device, stream),
+		        DISPATCH_SECONDS.labels(device, stream))
+
+	def _dispatch(self, consumers, pool, count, data, timestamp, stream_metrics):
+		frames, drops, dispatch_time = stream_metrics
+		now = time.time()
+		frames.inc()
 		with self.lock:
-			for k,v in self.video_consumers.items():
-				if self.video_frame % v == 0:
-					k.put(np.copy(data))
+			queues = [k for k,v in consumers.items() if count % v == 0]
+			if not queues:
+				return
+			if INVERT_KINECT:
+				data = data[::-1, ::-1] # Flip upside down
+			# Copy once into a pooled buffer shared by all consumers
+			frame = pool.get(data, count, timestamp, now)
+			dropped = 0
+			for k in queues:
+				dropped += k.put(frame.acquire())
+			frame.release()
+		if dropped:
+			drops.inc(dropped)
+		dispatch_time.observe(time.time() - now)
+
+	def _video_cb(self, dev, data, timestamp):
+		self._dispatch(self.video_consumers, self.video_pool, self.video_frame, data, timestamp,
+		               self.video_metrics)
 		self.video_frame += 1
 
 	def _depth_cb(self, dev, data, timestamp):
-		if INVERT_KINECT:
-			data = data[::-1, ::-1] # Flip upside down
-		with self.lock:
-			for k,v in self.depth_consumers.items():
-				if self.depth_frame % v == 0:
-					k.put(data)
+		self._dispatch(self.depth_consumers, self.depth_pool, self.depth_frame, data, timestamp,
+		               self.depth_metrics)
 		self.depth_frame += 1
 
-	def depth_stream(self, decimate=1):
-		consumer = KinectConsumer(self._remove_depth_stream)
+	# queue_size=1 only delivers the latest frame, larger sizes buffer up to
+	# that many frames before dropping the oldest
+	def depth_stream(self, decimate=1, queue_size=1):
+		consumer = KinectConsumer(self._remove_depth_stream, queue_size)
 		with self.lock:
 			if not self.depth_consumers:
 				self.update.set()
@@ -99,8 +347,8 @@ class KinectStreamer(threading.Thread):
 				self.update.set()
 				self.update_cond.notify()
 
-	def video_stream(self, decimate=1):
-		consumer = KinectConsumer(self._remove_video_stream)
+	def video_stream(self, decimate=1, queue_size=1):
+		consumer = KinectConsumer(self._remove_video_stream, queue_size)
 		with self.lock:
 			if not self.video_consumers:
 				self.update.set()
@@ -125,45 +373,39 @@ class KinectStreamer(threading.Thread):
 
 	def update_streams(self):
 		if self.depth_started and not self.depth_consumers:
-			logging.info("Stopping depth")
-			freenect.stop_depth(self.dev)
+			logging.info("Stopping depth on Kinect %d", self.device)
+			self.source.stop_depth()
 			self.depth_started = False
 		elif not self.depth_started and self.depth_consumers:
-			logging.info("Starting depth")
-			freenect.start_depth(self.dev)
+			logging.info("Starting depth on Kinect %d", self.device)
+			self.source.start_depth()
 			self.depth_started = True
 
 		if self.video_started and not self.video_consumers:
-			logging.info("Stopping video")
-			freenect.stop_video(self.dev)
+			logging.info("Stopping video on Kinect %d", self.device)
+			self.source.stop_video()
 			self.video_started = False
 		elif not self.video_started and self.video_consumers:
-			logging.info("Starting video")
-			freenect.start_video(self.dev)
+			logging.info("Starting video on Kinect %d", self.device)
+			self.source.start_video()
 			self.video_started = True
 
-	def _body(self, ctx):
+	def _body(self):
 		with self.lock:
 			if self.update.isSet():
 				self.update_streams()
 				if not self.video_started and not self.depth_started:
-					raise freenect.Kill()
+					raise StopRunloop()
 				self.update.clear()
 				if not self.keep_running:
-					raise freenect.Kill()
+					raise StopRunloop()
 			if self.led_update is not None:
-				freenect.set_led(self.dev, self.led_update)
+				self.source.set_led(self.led_update)
 				self.led_update = None
 
 	def run(self):
 		try:
-			self.ctx = freenect.init()
-			self.dev = freenect.open_device(self.ctx, 0)
-
-			freenect.set_depth_mode(self.dev, freenect.RESOLUTION_MEDIUM, freenect.DEPTH_11BIT)
-			freenect.set_depth_callback(self.dev, self._depth_cb)
-			freenect.set_video_mode(self.dev, freenect.RESOLUTION_MEDIUM, freenect.VIDEO_RGB)
-			freenect.set_video_callback(self.dev, self._video_cb)
+			self.source.open(self._depth_cb, self._video_cb)
 
 			self.video_started = False
 			self.depth_started = False
@@ -171,7 +413,7 @@ class KinectStreamer(threading.Thread):
 			while self.keep_running:
 				with self.lock:
 					if self.led_update is not None:
-						freenect.set_led(self.dev, self.led_update)
+						self.source.set_led(self.led_update)
 						self.led_update = None
 					self.update_streams()
 					if not self.video_started and not self.depth_started:
@@ -180,22 +422,24 @@ class KinectStreamer(threading.Thread):
 					self.update.clear()
 					if not self.keep_running:
 						break
-				freenect.base_runloop(self.ctx, self._body)
+				self.source.runloop(self._body)
+		except SourceExhausted:
+			logging.info("Frame source of Kinect %d exhausted", self.device)
 		finally:
 			with self.lock:
 				for k in self.depth_consumers.keys() + self.video_consumers.keys():
 					k.put(StreamerDied("The Kinect streamer died"))
-				self.depth_consumers = {}
-				self.video_consumers = {}
+				# Cleared in place, the consumer gauges hold on to these
+				self.depth_consumers.clear()
+				self.video_consumers.clear()
 				self.update_streams()
-			freenect.close_device(self.dev)
-			freenect.shutdown(self.ctx)
+			self.source.close()
 
 
 	def start(self):
 		if self.is_alive():
 			return
-		logging.info("Kinect streamer started")
+		logging.info("Kinect streamer %d started", self.device)
 		self.keep_running = True
 		threading.Thread.start(self)
 
@@ -207,4 +451,66 @@ class KinectStreamer(threading.Thread):
 			self.update.set()
 			self.update_cond.notify()
 		self.join()
-		logging.info("Kinect streamer stopped")
+		logging.info("Kinect streamer %d stopped", self.device)
+
+# Holds on to the latest frame of a stream while running, so that a still of
+# a given moment is at hand without waiting for the stream to start.
+class FrameKeeper(object):
+	def __init__(self, kinect, kind, decimate=5):
+		self.kinect = kinect
+		self.kind = kind
+		self.decimate = decimate
+		self.lock = threading.Lock()
+		self.frame = None
+		self.stream = None
+		self.thread = None
+		self.keep_running = False
+
+	# The latest Frame, for the caller to release, or None
+	def latest(self):
+		with self.lock:
+			if self.frame is None:
+				return None
+			return self.frame.acquire()
+
+	def _run(self, stream):
+		try:
+			while self.keep_running:
+				frame = stream.next_frame().acquire()
+				with self.lock:
+					old, self.frame = self.frame, frame
+				release_frame(old)
+		except (ConsumerStopped, StreamerDied):
+			pass
+		finally:
+			stream.stop()
+			with self.lock:
+				old, self.frame = self.frame, None
+			release_frame(old)
+
+	def is_alive(self):
+		return self.thread is not None and self.thread.is_alive()
+
+	def start(self):
+		if self.is_alive():
+			return
+		self.keep_running = True
+		if self.kind == "video":
+			self.stream = self.kinect.video_stream(self.decimate)
+		else:
+			self.stream = self.kinect.depth_stream(self.decimate)
+		self.thread = threading.Thread(target=self._run, args=(self.stream,),
+		                               name="FrameKeeper-%d-%s" % (self.kinect.device, self.kind))
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		if not self.is_alive():
+			return
+		self.keep_running = False
+		self.stream.interrupt()
+		self.thread.join()
+
+# One streamer per configured device
+def create_streamers():
+	return [KinectStreamer(device=device) for device in KINECT_DEVICES]
@@ -1,26 +1,188 @@
 #!/usr/bin/env python
 
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+import itertools
 import logging
+import Queue
 import smtplib
+import socket
 import sys
+import threading
 import time
 
 from config import *
 
-def send_alert(subject):
-	logging.info("Sending mail alert (%s)" % subject)
-
+# images is a list of (filename, JPEG data) attachments
+def build_message(subject, images=()):
 	body = MAIL_TEMPLATE % subject
 	msg = MIMEText(body)
+	if images:
+		text, msg = msg, MIMEMultipart()
+		msg.attach(text)
+		for filename, data in images:
+			image = MIMEImage(data, "jpeg")
+			image.add_header("Content-Disposition", "attachment", filename=filename)
+			msg.attach(image)
 	msg['Subject'] = 'Security alert: %s' % subject
 	msg['From'] = MAIL_FROM
 	msg['To'] = MAIL_TO
+	return msg
 
-	smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+def smtp_connect():
+	smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
 	if SMTP_TLS:
 		smtp.starttls()
 	if SMTP_USER is not None and SMTP_PASSWORD is not None:
 		smtp.login(SMTP_USER, SMTP_PASSWORD)
+	return smtp
+
+def send_alert(subject):
+	logging.info("Sending mail alert (%s)" % subject)
+	msg = build_message(subject)
+	smtp = smtp_connect()
 	smtp.sendmail(MAIL_FROM, [MAIL_TO], msg.as_string())
 	smtp.quit()
+
+QUEUED = "queued"
+SENT = "sent"
+RETRYING = "retrying"
+FAILED = "failed"
+
+# attachments, if given, provide render(), returning a list of (filename,
+# JPEG data), and release(). They are rendered by the dispatcher thread when
+# the message is built, and released right after.
+class Alert(object):
+	ids = itertools.count(1)
+
+	def __init__(self, subject, attachments=None):
+		self.id = next(self.ids)
+		self.subject = subject
+		self.attachments = attachments
+		self.status = QUEUED
+		self.attempts = 0
+		self.error = None
+
+	def failed(self):
+		return self.status == FAILED
+
+	def message(self):
+		images = []
+		attachments, self.attachments = self.attachments, None
+		if attachments is not None:
+			try:
+				images = attachments.render()
+			except Exception:
+				logging.exception("Could not render alert attachments")
+			finally:
+				attachments.release()
+		return build_message(self.subject, images)
+
+# Sends alerts from a background thread, so that the controller never waits
+# on the network. The SMTP connection is kept open between alerts (and can be
+# opened ahead of time with prepare()), and failed sends are retried
+# SMTP_RETRIES times, with the delay doubling from SMTP_RETRY_DELAY.
+# on_status(alert) is called from the dispatcher thread on every change.
+class AlertDispatcher(threading.Thread):
+	PREPARE = "prepare"
+
+	def __init__(self, on_status=None):
+		threading.Thread.__init__(self, name="AlertDispatcher")
+		self.daemon = True
+		self.on_status = on_status
+		self.queue = Queue.Queue()
+		self.stopping = threading.Event()
+		self.smtp = None
+		self.last_used = 0
+
+	def send(self, subject, attachments=None):
+		alert = Alert(subject, attachments)
+		logging.info("Queueing mail alert (%s)", subject)
+		self.queue.put(alert)
+		return alert
+
+	# Connect now, so that the next alert does not wait for it
+	def prepare(self):
+		self.queue.put(self.PREPARE)
+
+	def _status(self, alert, status, error=None):
+		alert.status = status
+		alert.error = error
+		if self.on_status is not None:
+			try:
+				self.on_status(alert)
+			except Exception:
+				logging.exception("Alert status callback failed")
+
+	def _connection(self):
+		if self.smtp is not None and time.time() - self.last_used > SMTP_IDLE:
+			# The server has likely given up on it
+			self._disconnect()
+		if self.smtp is None:
+			self.smtp = smtp_connect()
+		self.last_used = time.time()
+		return self.smtp
+
+	def _disconnect(self):
+		smtp, self.smtp = self.smtp, None
+		if smtp is None:
+			return
+		try:
+			smtp.quit()
+		except (smtplib.SMTPException, socket.error):
+			smtp.close()
+
+	def _deliver(self, alert):
+		data = alert.message().as_string()
+		delay = SMTP_RETRY_DELAY
+		while True:
+			alert.attempts += 1
+			reused = self.smtp is not None
+			try:
+				self._connection().sendmail(MAIL_FROM, [MAIL_TO], data)
+				self.last_used = time.time()
+				self._status(alert, SENT)
+				logging.info("Mail alert sent (%s)", alert.subject)
+				return
+			except (smtplib.SMTPException, socket.error) as e:
+				self._disconnect()
+				if reused and isinstance(e, smtplib.SMTPServerDisconnected):
+					# A kept connection was dropped, reconnect right away
+					alert.attempts -= 1
+					continue
+				if alert.attempts >= SMTP_RETRIES:
+					logging.error("Mail alert failed (%s): %s", alert.subject, e)
+					self._status(alert, FAILED, str(e))
+					return
+				logging.warning("Mail alert attempt %d failed (%s), retrying in %gs",
+				                alert.attempts, e, delay)
+				self._status(alert, RETRYING, str(e))
+			if self.stopping.wait(delay):
+				self._status(alert, FAILED, "Shutting down")
+				return
+			delay *= 2
+
+	def run(self):
+		try:
+			while True:
+				item = self.queue.get()
+				if item is None:
+					return
+				if item == self.PREPARE:
+					try:
+						self._connection()
+					except (smtplib.SMTPException, socket.error) as e:
+						logging.warning("Could not connect to mail server: %s", e)
+						self._disconnect()
+				else:
+					self._deliver(item)
+		finally:
+			self._disconnect()
+
+	def stop(self):
+		if not self.is_alive():
+			return
+		self.stopping.set()
+		self.queue.put(None)
+		self.join()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# Counters, gauges and histograms, exported in the Prometheus text format at
+# /metrics. Hot paths should look up their labelled series once and keep it,
+# e.g. frames = FRAMES.labels("depth"), then call frames.inc() per frame.
+# Updates are not locked: under the GIL a lost update is rare enough not to
+# matter for monitoring.
+
+import bisect
+import threading
+import time
+
+class Registry(object):
+	def __init__(self):
+		self.metrics = []
+		self.lock = threading.Lock()
+
+	def register(self, metric):
+		with self.lock:
+			self.metrics.append(metric)
+		return metric
+
+	def render(self):
+		with self.lock:
+			metrics = list(self.metrics)
+		lines = []
+		for metric in metrics:
+			lines.append("# HELP %s %s" % (metric.name, metric.help))
+			lines.append("# TYPE %s %s" % (metric.name, metric.type))
+			lines.extend(metric.samples())
+		return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def _format_labels(names, values, extra=()):
+	pairs = zip(names, values) + list(extra)
+	if not pairs:
+		return ""
+	return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+	                         for name, value in pairs)
+
+def _format_value(value):
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value))
+
+class Metric(object):
+	def __init__(self, name, help, labels=(), registry=REGISTRY):
+		self.name = name
+		self.help = help
+		self.label_names = tuple(labels)
+		self.children = {}
+		self.lock = threading.Lock()
+		if not self.label_names:
+			self.children[()] = self._child()
+		registry.register(self)
+
+	def labels(self, *values):
+		values = tuple(str(v) for v in values)
+		child = self.children.get(values)
+		if child is None:
+			if len(values) != len(self.label_names):
+				raise ValueError("%s takes labels %r" % (self.name, self.label_names))
+			with self.lock:
+				child = self.children.setdefault(values, self._child())
+		return child
+
+	def _series(self):
+		with self.lock:
+			return sorted(self.children.items())
+
+	# Unlabelled metrics can be used directly
+	def __getattr__(self, name):
+		if name.startswith("_") or () not in self.__dict__.get("children", {}):
+			raise AttributeError(name)
+		return getattr(self.children[()], name)
+
+	# State of all series, to copy metrics updated in another process
+	def dump(self):
+		return dict((values, child.dump()) for values, child in self._series())
+
+	def load(self, state):
+		for values, child_state in state.items():
+			self.labels(*values).load(child_state)
+
+class CounterChild(object):
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, amount=1):
+		self.value += amount
+
+	def dump(self):
+		return self.value
+	def load(self, state):
+		self.value = state
+
+class Counter(Metric):
+	type = "counter"
+
+	def _child(self):
+		return CounterChild()
+
+	def samples(self):
+		return ["%s%s %s" % (self.name, _format_labels(self.label_names, values),
+		                     _format_value(child.value))
+		        for values, child in self._series()]
+
+class GaugeChild(object):
+	def __init__(self):
+		self.value = 0
+		self.func = None
+
+	def set(self, value):
+		self.value = value
+
+	def inc(self, amount=1):
+		self.value += amount
+
+	def dec(self, amount=1):
+		self.value -= amount
+
+	# Compute the value when scraped instead
+	def set_function(self, func):
+		self.func = func
+
+	def get(self):
+		if self.func is not None:
+			return self.func()
+		return self.value
+
+	def dump(self):
+		return self.get()
+	def load(self, state):
+		self.value = state
+
+class Gauge(Metric):
+	type = "gauge"
+
+	def _child(self):
+		return GaugeChild()
+
+	def samples(self):
+		return ["%s%s %s" % (self.name, _format_labels(self.label_names, values),
+		                     _format_value(child.get()))
+		        for values, child in self._series()]
+
+# Default buckets, in seconds, for timing hot paths
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+class HistogramChild(object):
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def dump(self):
+		return list(self.counts), self.sum, self.count
+	def load(self, state):
+		counts, self.sum, self.count = state
+		self.counts = list(counts)
+
+class Histogram(Metric):
+	type = "histogram"
+
+	def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS, registry=REGISTRY):
+		self.buckets = tuple(sorted(buckets))
+		Metric.__init__(self, name, help, labels, registry)
+
+	def _child(self):
+		return HistogramChild(self.buckets)
+
+	def samples(self):
+		lines = []
+		for values, child in self._series():
+			total = 0
+			for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+				total += count
+				lines.append("%s_bucket%s %d" % (self.name, _format_labels(
+					self.label_names, values, [("le", _format_value(bound))]), total))
+			labels = _format_labels(self.label_names, values)
+			lines.append("%s_sum%s %s" % (self.name, labels, _format_value(child.sum)))
+			lines.append("%s_count%s %d" % (self.name, labels, child.count))
+		return lines
+
+# Timer for the pipelines' begin()/mark(stage) hooks, observing each stage's
+# duration into a histogram labelled by stage, after any other labels given
+class StageTimer(object):
+	def __init__(self, histogram, labels=()):
+		self.histogram = histogram
+		self.labels = tuple(labels)
+		self.stages = {}
+		self.last = None
+
+	def begin(self):
+		self.last = time.time()
+
+	def mark(self, stage):
+		now = time.time()
+		child = self.stages.get(stage)
+		if child is None:
+			child = self.stages[stage] = self.histogram.labels(*self.labels + (stage,))
+		child.observe(now - self.last)
+		self.last = now
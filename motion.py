@@ -1,21 +1,28 @@
 #!/usr/bin/env python
 
+import ctypes
 import cv2
+import functools
 import logging
+import math
+import multiprocessing
 import numpy as np
+import os
+import Queue
 import threading
+import time
 
+import depthlut
 import kinectcore
+import metrics
 
 from config import *
 
 def frame_to_depth(frame):
-	mask = frame > 1070
-	frame = frame.astype(np.float)
-	# Calculate depth in meters as a function of depth value
-	depth = 1.0 / (frame * -0.0030711016 + 3.3309495161)
-	# Fill the masked (invalid) areas with "5 meters" for computational purposes
-	depth = np.ma.filled(np.ma.array(depth, mask=mask), 5)
+	mask = depthlut.lookup(depthlut.RAW_INVALID, frame)
+	# Depth in meters, with the invalid areas filled with "5 meters" for
+	# computational purposes
+	depth = depthlut.lookup(depthlut.RAW_TO_DEPTH, frame)
 
 	return depth, mask
 
@@ -28,118 +35,1077 @@ def depth_to_img(frame):
 def delta_to_img(frame):
 	return np.clip((60 * frame), 0, 255).astype(np.uint8)
 
-class MotionSensor(threading.Thread):
+# depth_filter_<n>.npy, or depth_filter.npy for device 0
+def load_depth_filter(device=0):
+	paths = [kinectcore.device_file("depth_filter.npy", device)]
+	if device == 0:
+		paths.append("depth_filter.npy")
+	for path in paths:
+		try:
+			return np.load(path)
+		except IOError:
+			pass
+	return None
 
-	def __init__(self, kinect):
-		threading.Thread.__init__(self, name="MotionSensor")
-		self.kinect = kinect
-		self.debug = False
-		self.detected = threading.Event()
-		self.keep_running = True
+# Pipelines leave per-pixel results of the last frame in motion_map (the
+# motion value contribution of each pixel) and lost_map (lost pixels).
+# model() returns the reference model as a dict of arrays, which
+# set_model() restores in place of reset().
+# One motion detection step per depth frame. If a timer is set, its begin()
+# is called at the start of each frame and mark(stage) after each stage.
+class MotionPipeline(object):
+	def __init__(self, depth_filter=None):
+		self.depth_filter = depth_filter
+		self.timer = None
+		# Create dilation kernel
+		self.dilate_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (11, 11))
 
-	def run(self):
-		self.detected.clear()
-		stream = self.kinect.depth_stream(5)
+	def reset(self, frame):
+		ref, mask = frame_to_depth(frame)
+		# Apply depth filter
+		if self.depth_filter is not None:
+			ref = np.minimum(ref, self.depth_filter)
+		# Blur it
+		self.ref = cv2.GaussianBlur(ref, (0, 0), 2)
+		# Create reference mask buffer
+		self.ref_mask_buf = mask.astype(np.float)
 
-		# Load depth filter
-		try:
-			depth_filter = np.load("depth_filter.npy")
-		except:
-			depth_filter = None
+	def model(self):
+		return {"ref": self.ref, "ref_mask_buf": self.ref_mask_buf}
 
-		# Drop initial frames that are less than 50% valid
-		while np.count_nonzero(stream.next() != 2047) < VALID_THRESHOLD:
-			if not self.keep_running:
-				return
+	def set_model(self, model):
+		self.ref = model["ref"].astype(np.float)
+		self.ref_mask_buf = model["ref_mask_buf"].astype(np.float)
 
-		# Drop a few more frames to ensure a stable image
-		for i in range(30):
-			stream.next()
-			if not self.keep_running:
-				return
+	def process(self, frame):
+		timer = self.timer
+		if timer:
+			timer.begin()
+
+		# Get current frame
+		depth, mask = frame_to_depth(frame)
 
-		# Obtain reference image
-		ref, mask = frame_to_depth(stream.next())
 		# Apply depth filter
-		if depth_filter is not None:
-			ref = np.minimum(ref, depth_filter)
-		# Blur it
-		ref = cv2.GaussianBlur(ref, (0, 0), 2)
-		# Create reference mask buffer
-		ref_mask_buf = mask.astype(np.float)
+		if self.depth_filter is not None:
+			depth = np.minimum(depth, self.depth_filter)
+		if timer:
+			timer.mark("depth")
+
+		# Blur the depth
+		depth = cv2.GaussianBlur(depth, (0, 0), 2)
+		if timer:
+			timer.mark("blur")
 
+		# Booleanize the current reference mask buffer
+		ref_mask = self.ref_mask_buf > 0.5
+		# Mask out invalid pixels in either image
+		invalid = np.logical_or(mask, ref_mask)
+		# Dilate the mask
+		invalid = cv2.dilate(invalid.astype(np.uint8), self.dilate_kernel).astype(bool)
 
+		# Count pixels lost vs. the reference image
+		self.lost_map = lost = np.logical_and(mask, np.logical_not(ref_mask))
+		lost_count = np.count_nonzero(lost)
+		if timer:
+			timer.mark("mask")
+
+		# Mask both arrays
+		self.masked_ref = np.ma.array(self.ref, mask=ref_mask)
+		self.masked_depth = np.ma.array(depth, mask=invalid)
+
+		# Compare, blur the difference
+		delta = np.ma.filled(np.abs(self.masked_ref - self.masked_depth), 0)
+		delta = cv2.GaussianBlur(delta, (0, 0), 1)
+		# Mask out pixels under the threshold
+		self.delta = np.ma.array(self.ref, mask=(delta < Z_THRESHOLD))
+		# Compute the sum of deltas as a motion value
+		self.motion_map = np.ma.filled(self.delta, 0)
+		motion = sum(sum(self.motion_map))
+		if timer:
+			timer.mark("compare")
+
+		# Accumulate into the reference buffer
+		self.ref = self.ref * (1 - DECAY_K) + np.where(mask, self.ref, depth) * DECAY_K
+		self.ref_mask_buf = self.ref_mask_buf * (1 - DECAY_K) + mask * DECAY_K
+		if timer:
+			timer.mark("decay")
+
+		return motion, lost_count
+
+	def debug_images(self):
+		return (depth_to_img(self.masked_ref), depth_to_img(self.masked_depth),
+		        delta_to_img(np.ma.filled(self.delta, 0)))
+
+# Same algorithm as MotionPipeline, but working in place on preallocated
+# float32 buffers with explicit masks, so that no frame-sized arrays are
+# allocated per frame. uint8 masks are also viewed as bool arrays. For
+# downsampled frames, scale shrinks the blurs and the dilation to match.
+class InplaceMotionPipeline(object):
+	def __init__(self, depth_filter=None, scale=1):
+		if depth_filter is not None:
+			depth_filter = depth_filter.astype(np.float32)
+		self.depth_filter = depth_filter
+		self.timer = None
+		self.depth_sigma = 2.0 / scale
+		self.delta_sigma = 1.0 / scale
 		# Create dilation kernel
-		dilate_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (11, 11))
+		size = max(3, int(round(11.0 / scale)) | 1)
+		self.dilate_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+		self.shape = None
+
+	def _allocate(self, shape):
+		self.shape = shape
+		self.raw_depth = np.empty(shape, np.float32)
+		self.depth = np.empty(shape, np.float32)
+		self.ref = np.empty(shape, np.float32)
+		self.ref_mask_buf = np.empty(shape, np.float32)
+		self.diff = np.empty(shape, np.float32)
+		self.delta = np.empty(shape, np.float32)
+		self.mask_u8 = np.empty(shape, np.uint8)
+		self.mask = self.mask_u8.view(np.bool_)
+		self.valid_u8 = np.empty(shape, np.uint8)
+		self.valid = self.valid_u8.view(np.bool_)
+		self.ref_mask = np.empty(shape, np.bool_)
+		self.scratch_u8 = np.empty(shape, np.uint8)
+		self.scratch = self.scratch_u8.view(np.bool_)
+		self.lost_map = np.empty(shape, np.bool_)
+		self.invalid_u8 = np.empty(shape, np.uint8)
+		self.invalid = self.invalid_u8.view(np.bool_)
+
+	def _load(self, frame):
+		depthlut.lookup(depthlut.RAW_INVALID_U8, frame, self.mask_u8)
+		depthlut.lookup(depthlut.RAW_TO_DEPTH32, frame, self.raw_depth)
+		if self.depth_filter is not None:
+			np.minimum(self.raw_depth, self.depth_filter, self.raw_depth)
+
+	def reset(self, frame):
+		if self.shape != frame.shape:
+			self._allocate(frame.shape)
+		self._load(frame)
+		cv2.GaussianBlur(self.raw_depth, (0, 0), self.depth_sigma, dst=self.ref)
+		self.ref_mask_buf[...] = self.mask_u8
+
+	def model(self):
+		return {"ref": self.ref, "ref_mask_buf": self.ref_mask_buf}
+
+	def set_model(self, model):
+		shape = model["ref"].shape
+		if self.shape != shape:
+			self._allocate(shape)
+		self.ref[...] = model["ref"]
+		self.ref_mask_buf[...] = model["ref_mask_buf"]
+
+	def process(self, frame):
+		timer = self.timer
+		if timer:
+			timer.begin()
+
+		# Get current frame and apply depth filter
+		self._load(frame)
+		if timer:
+			timer.mark("depth")
+
+		# Blur the depth
+		cv2.GaussianBlur(self.raw_depth, (0, 0), self.depth_sigma, dst=self.depth)
+		if timer:
+			timer.mark("blur")
+
+		# Booleanize the current reference mask buffer
+		np.greater(self.ref_mask_buf, 0.5, self.ref_mask)
+		# Mask out invalid pixels in either image, and dilate the mask
+		np.logical_or(self.mask, self.ref_mask, self.scratch)
+		cv2.dilate(self.scratch_u8, self.dilate_kernel, dst=self.invalid_u8)
+
+		# Count pixels lost vs. the reference image
+		np.greater(self.mask, self.ref_mask, self.lost_map)
+		lost_count = np.count_nonzero(self.lost_map)
+		if timer:
+			timer.mark("mask")
+
+		# Compare, blur the difference
+		np.subtract(self.ref, self.depth, self.diff)
+		np.abs(self.diff, self.diff)
+		np.copyto(self.diff, 0, where=self.invalid)
+		cv2.GaussianBlur(self.diff, (0, 0), self.delta_sigma, dst=self.delta)
+		# Sum the reference depth of pixels over the threshold as a motion value
+		np.greater_equal(self.delta, Z_THRESHOLD, self.scratch)
+		np.multiply(self.ref, self.scratch, self.diff)
+		self.motion_map = self.diff
+		motion = self.diff.sum(dtype=np.float64)
+		if timer:
+			timer.mark("compare")
+
+		# Accumulate valid pixels into the reference buffer
+		np.logical_not(self.mask, self.valid)
+		cv2.accumulateWeighted(self.depth, self.ref, DECAY_K, mask=self.valid_u8)
+		cv2.accumulateWeighted(self.mask_u8, self.ref_mask_buf, DECAY_K)
+		if timer:
+			timer.mark("decay")
+
+		return motion, lost_count
+
+	def debug_images(self):
+		return (depth_to_img(np.ma.array(self.ref, mask=self.ref_mask)),
+		        depth_to_img(np.ma.array(self.depth, mask=self.invalid)),
+		        delta_to_img(self.diff))
+
+# Coarse-to-fine variant: a downsampled copy of the pipeline runs on every
+# frame, and the full resolution comparison only runs on the tiles where
+# the coarse level sees candidate changes. The full resolution reference is
+# kept up to date on every frame, but accumulated unblurred and only blurred
+# where it is compared, which is equivalent up to the handling of pixels at
+# the edges of invalid areas.
+class PyramidMotionPipeline(object):
+	def __init__(self, depth_filter=None, level=2, tile_size=TILE_SIZE):
+		self.factor = 2 ** level
+		self.tile_size = tile_size
+		if depth_filter is not None:
+			self.coarse = InplaceMotionPipeline(depth_filter[::self.factor, ::self.factor],
+			                                    self.factor)
+			depth_filter = depth_filter.astype(np.float32)
+		else:
+			self.coarse = InplaceMotionPipeline(None, self.factor)
+		self.fine = InplaceMotionPipeline(depth_filter)
+		self.timer = None
+		self.shape = None
+
+	def _allocate(self, shape):
+		self.shape = shape
+		fine = self.fine
+		fine._allocate(shape)
+		self.ref_raw = np.empty(shape, np.float32)
+		self.motion_map = np.zeros(shape, np.float32)
+		self.lost_map = fine.lost_map
+		self.roi = None
+		self.coarse_tile = max(1, self.tile_size // self.factor)
+
+	def reset(self, frame):
+		if self.shape != frame.shape:
+			self._allocate(frame.shape)
+		self.coarse.reset(frame[::self.factor, ::self.factor])
+		fine = self.fine
+		fine._load(frame)
+		self.ref_raw[...] = fine.raw_depth
+		fine.ref_mask_buf[...] = fine.mask_u8
+
+	def model(self):
+		coarse = self.coarse.model()
+		return {"ref": self.ref_raw, "ref_mask_buf": self.fine.ref_mask_buf,
+		        "coarse_ref": coarse["ref"], "coarse_ref_mask_buf": coarse["ref_mask_buf"]}
+
+	def set_model(self, model):
+		shape = model["ref"].shape
+		if self.shape != shape:
+			self._allocate(shape)
+		self.coarse.set_model({"ref": model["coarse_ref"],
+		                       "ref_mask_buf": model["coarse_ref_mask_buf"]})
+		self.ref_raw[...] = model["ref"]
+		self.fine.ref_mask_buf[...] = model["ref_mask_buf"]
+
+	def _candidates(self):
+		# Tiles with coarse level pixels near the motion threshold, or lost
+		coarse = self.coarse
+		np.greater_equal(coarse.delta, Z_THRESHOLD * PYRAMID_CANDIDATE, coarse.scratch)
+		np.logical_or(coarse.scratch, coarse.lost_map, coarse.scratch)
+		if not coarse.scratch.any():
+			return None
+		h, w = coarse.shape
+		step = self.coarse_tile
+		tiles = np.logical_or.reduceat(np.logical_or.reduceat(
+			coarse.scratch, np.arange(0, h, step), axis=0), np.arange(0, w, step), axis=1)
+		ys, xs = np.nonzero(tiles)
+		size = self.tile_size
+		h, w = self.shape
+		return (slice(max(0, ys.min() * size - BLUR_MARGIN), min(h, (ys.max() + 1) * size + BLUR_MARGIN)),
+		        slice(max(0, xs.min() * size - BLUR_MARGIN), min(w, (xs.max() + 1) * size + BLUR_MARGIN)))
+
+	def process(self, frame):
+		timer = self.timer
+		if timer:
+			timer.begin()
+
+		self.coarse.process(frame[::self.factor, ::self.factor])
+		roi = self._candidates()
+		if timer:
+			timer.mark("coarse")
+
+		fine = self.fine
+		fine._load(frame)
+		if timer:
+			timer.mark("depth")
+
+		# Lost pixels are cheap enough to count at full resolution
+		np.greater(fine.ref_mask_buf, 0.5, fine.ref_mask)
+		np.greater(fine.mask, fine.ref_mask, fine.lost_map)
+		lost_count = np.count_nonzero(fine.lost_map)
+		if timer:
+			timer.mark("mask")
+
+		if self.roi is not None:
+			self.motion_map[self.roi] = 0
+		self.roi = roi
+		motion = 0
+		if roi is not None:
+			motion = self._compare(roi)
+		if timer:
+			timer.mark("fine")
+
+		# Accumulate valid pixels into the reference buffer
+		np.logical_not(fine.mask, fine.valid)
+		cv2.accumulateWeighted(fine.raw_depth, self.ref_raw, DECAY_K, mask=fine.valid_u8)
+		cv2.accumulateWeighted(fine.mask_u8, fine.ref_mask_buf, DECAY_K)
+		if timer:
+			timer.mark("decay")
+
+		return motion, lost_count
+
+	def _compare(self, roi):
+		fine = self.fine
+		ref = fine.ref[roi]
+		depth = fine.depth[roi]
+		diff = fine.diff[roi]
+		delta = fine.delta[roi]
+		scratch = fine.scratch[roi]
+		invalid = fine.invalid_u8[roi]
+
+		cv2.GaussianBlur(self.ref_raw[roi], (0, 0), 2, dst=ref)
+		cv2.GaussianBlur(fine.raw_depth[roi], (0, 0), 2, dst=depth)
+		np.logical_or(fine.mask[roi], fine.ref_mask[roi], scratch)
+		cv2.dilate(fine.scratch_u8[roi], fine.dilate_kernel, dst=invalid)
+
+		np.subtract(ref, depth, diff)
+		np.abs(diff, diff)
+		np.copyto(diff, 0, where=invalid.view(np.bool_))
+		cv2.GaussianBlur(diff, (0, 0), 1, dst=delta)
+		np.greater_equal(delta, Z_THRESHOLD, scratch)
+		motion_map = self.motion_map[roi]
+		np.multiply(ref, scratch, motion_map)
+		return motion_map.sum(dtype=np.float64)
+
+	def debug_images(self):
+		fine = self.fine
+		return (depth_to_img(np.ma.array(self.ref_raw, mask=fine.ref_mask)),
+		        depth_to_img(np.ma.array(fine.raw_depth, mask=fine.mask)),
+		        delta_to_img(self.motion_map))
+
+def create_pipeline(depth_filter=None):
+	if MOTION_PYRAMID:
+		return PyramidMotionPipeline(depth_filter, MOTION_PYRAMID)
+	elif MOTION_INPLACE:
+		return InplaceMotionPipeline(depth_filter)
+	else:
+		return MotionPipeline(depth_filter)
+
+class Zone(object):
+	def __init__(self, name, rect, motion_threshold, lost_threshold):
+		self.name = name
+		# (x0, y0, x1, y1) in pixels, None for the whole frame
+		self.rect = rect
+		self.motion_threshold = motion_threshold
+		self.lost_threshold = lost_threshold
+
+# MOTION_ZONES can also map device numbers to their zones
+def load_zones(device=0):
+	zones = MOTION_ZONES
+	if isinstance(zones, dict):
+		zones = zones.get(device)
+	if not zones:
+		return [Zone("all", None, MOTION_THRESHOLD, LOST_THRESHOLD)]
+	return [Zone(*zone) for zone in zones]
+
+# Distance (pixels) over which a pixel affects motion results through the
+# blurs and the mask dilation
+BLUR_MARGIN = 8 + 5 + 4
+
+# Splits the frame into tiles and only runs the pipeline on the area covered
+# by the zones. Motion is evaluated per zone over its live tiles, those not
+# completely removed by the depth filter, and lost pixels over all the tiles
+# it overlaps, as blinding the sensor also shows in filtered areas.
+class ZoneDetector(object):
+	def __init__(self, depth_filter=None, zones=None, tile_size=TILE_SIZE,
+	             factory=create_pipeline):
+		self.depth_filter = depth_filter
+		self.zones = zones if zones is not None else load_zones()
+		self.tile_size = tile_size
+		self.factory = factory
+		self.timer = None
+		self.shape = None
+
+	def _setup(self, shape):
+		self.shape = shape
+		h, w = shape
+		size = self.tile_size
+		th, tw = (h + size - 1) // size, (w + size - 1) // size
+
+		# Tiles where the depth filter clamps everything to the minimum depth
+		# can never see motion
+		if self.depth_filter is not None:
+			dead_px = self.depth_filter <= depthlut.MIN_DEPTH
+			dead = np.logical_and.reduceat(np.logical_and.reduceat(
+				dead_px, np.arange(0, h, size), axis=0), np.arange(0, w, size), axis=1)
+		else:
+			dead = np.zeros((th, tw), bool)
+
+		zone_tiles = []
+		for zone in self.zones:
+			tiles = np.zeros((th, tw), bool)
+			x0, y0, x1, y1 = zone.rect or (0, 0, w, h)
+			tiles[max(0, y0 // size):(y1 + size - 1) // size,
+			      max(0, x0 // size):(x1 + size - 1) // size] = True
+			zone_tiles.append(tiles)
+		covered = np.logical_or.reduce(zone_tiles)
+		live = np.logical_and(covered, np.logical_not(dead))
+
+		if not live.any():
+			logging.warning("No live motion detection tiles, using the whole frame")
+			live[...] = True
+		ys, xs = np.nonzero(np.logical_or(covered, live))
+		margin = (BLUR_MARGIN + size - 1) // size
+		ty0, ty1 = max(0, ys.min() - margin), min(th, ys.max() + 1 + margin)
+		tx0, tx1 = max(0, xs.min() - margin), min(tw, xs.max() + 1 + margin)
+		self.roi = (slice(ty0 * size, min(h, ty1 * size)),
+		            slice(tx0 * size, min(w, tx1 * size)))
+		self.live = live[ty0:ty1, tx0:tx1]
+		# (motion tiles, lost tiles) of each zone
+		self.zone_tiles = [(np.logical_and(t[ty0:ty1, tx0:tx1], self.live), t[ty0:ty1, tx0:tx1])
+		                   for t in zone_tiles]
+		self.tile_y = np.arange(0, self.roi[0].stop - self.roi[0].start, size)
+		self.tile_x = np.arange(0, self.roi[1].stop - self.roi[1].start, size)
+		self.no_tiles = np.zeros(self.live.shape)
+		logging.info("Motion detection on %d of %d tiles", np.count_nonzero(live), th * tw)
+
+		depth_filter = self.depth_filter
+		if depth_filter is not None:
+			depth_filter = depth_filter[self.roi]
+		self.pipeline = self.factory(depth_filter)
+
+	def tile_sums(self, image):
+		if image.dtype == np.bool_:
+			image, dtype = image.view(np.uint8), np.int32
+		else:
+			dtype = np.float64
+		return np.add.reduceat(np.add.reduceat(image, self.tile_y, axis=0, dtype=dtype),
+		                       self.tile_x, axis=1)
+
+	def reset(self, frame):
+		if frame.shape != self.shape:
+			self._setup(frame.shape)
+		self.pipeline.reset(frame[self.roi])
+
+	# The pipeline's reference model, with the frame shape. Only restores
+	# into a detector with the same depth filter and zones.
+	def model(self):
+		model = dict(self.pipeline.model())
+		model["shape"] = np.array(self.shape)
+		return model
+
+	def set_model(self, model):
+		shape = tuple(model["shape"])
+		if shape != self.shape:
+			self._setup(shape)
+		roi_shape = (self.roi[0].stop - self.roi[0].start, self.roi[1].stop - self.roi[1].start)
+		if model["ref"].shape != roi_shape:
+			raise ValueError("the detection area changed")
+		self.pipeline.set_model(model)
+
+	# Returns (zone, motion, lost_count) for each zone
+	def process(self, frame):
+		self.pipeline.timer = self.timer
+		motion, lost_count = self.pipeline.process(frame[self.roi])
+		# Frames without any motion or lost pixels are the common case
+		if motion:
+			self.tile_motion = self.tile_sums(self.pipeline.motion_map)
+		else:
+			self.tile_motion = self.no_tiles
+		if lost_count:
+			self.tile_lost = self.tile_sums(self.pipeline.lost_map)
+		else:
+			self.tile_lost = self.no_tiles
+		scores = [(zone, self.tile_motion[motion_tiles].sum(), self.tile_lost[lost_tiles].sum())
+		          for zone, (motion_tiles, lost_tiles) in zip(self.zones, self.zone_tiles)]
+		if self.timer:
+			self.timer.mark("zones")
+		return scores
+
+	# Motion map of the last frame over the whole frame, as a new array
+	def motion_image(self):
+		image = np.zeros(self.shape, np.float32)
+		image[self.roi] = self.pipeline.motion_map
+		return image
+
+	def triggered(self, scores):
+		return [(zone, motion, lost) for zone, motion, lost in scores
+		        if motion > zone.motion_threshold or lost > zone.lost_threshold]
+
+	def debug_images(self):
+		return self.pipeline.debug_images()
+
+# Minimum interval between zone score reports (s)
+SCORE_INTERVAL = 0.5
+
+MOTION_FRAMES = metrics.Counter("motion_frames_total", "Depth frames run through motion detection",
+                                ["device"])
+MOTION_SECONDS = metrics.Histogram("motion_frame_seconds", "Motion detection time per frame",
+                                   ["device"])
+MOTION_STAGE_SECONDS = metrics.Histogram("motion_stage_seconds",
+                                         "Motion detection time per pipeline stage",
+                                         ["device", "stage"])
+MOTION_TRIGGERED = metrics.Counter("motion_triggered_frames_total",
+                                   "Frames where motion was detected in a zone", ["device"])
+RING_DROPPED = metrics.Counter("motion_ring_dropped_total",
+                               "Frames dropped because the motion worker was busy", ["device"])
+
+# Updated by the worker processes of ProcessMotionSensor and copied back. The
+# device is the first label of each.
+WORKER_METRICS = (MOTION_FRAMES, MOTION_SECONDS, MOTION_STAGE_SECONDS, MOTION_TRIGGERED)
+
+def worker_metrics(device):
+	device = str(device)
+	return [dict((values, state) for values, state in metric.dump().items()
+	             if values[0] == device)
+	        for metric in WORKER_METRICS]
+
+def score_report(scores):
+	return [(zone.name, int(motion), int(lost_count)) for zone, motion, lost_count in scores]
 
+# What a sensor saw when it detected motion, for alerts: the depth frame, the
+# motion map over the whole frame and the report of the triggered zones. A
+# depth Frame is held rather than copied until release(). Whoever is told of
+# the detection may attach the video Frame of that moment as video, which is
+# released along with it.
+class Detection(object):
+	def __init__(self, device, depth, motion_map, zones):
+		self.device = device
+		self.time = time.time()
+		self.frame = None
+		if isinstance(depth, kinectcore.Frame):
+			self.frame = depth.acquire()
+			depth = depth.data
+		self.depth = depth
+		self.motion_map = motion_map
+		self.zones = zones
+		self.video = None
+
+	def release(self):
+		frame, self.frame = self.frame, None
+		video, self.video = self.video, None
+		for held in (frame, video):
+			if held is not None:
+				held.release()
+
+# Reference updates after which the frame it was built from is down to 5%
+CONVERGED_UPDATES = int(math.ceil(math.log(0.05) / math.log(1 - DECAY_K)))
+
+# Detector and reference model, kept across the runs of a sensor. A run
+# resumes with the model if it was updated within MOTION_MODEL_MAX_AGE, or
+# else restores it from MOTION_MODEL_PATH if the saved one is recent enough,
+# and only otherwise builds a new one. Either way, the first frames of a run
+# are dropped until the stream is stable. While learning, the model is
+# updated on every decimate-th frame and nothing is triggered. Detection only
+# uses the model if it has converged on the scene in the current run, that
+# is, it took CONVERGED_UPDATES updates without motion; otherwise it starts
+# from a new reference, as the scene may have changed while the stream was
+# off, or people were still about. The model is saved every MOTION_MODEL_SAVE
+# seconds and when a run stops.
+class MotionEngine(object):
+	def __init__(self, device=0, model_path=MOTION_MODEL_PATH):
+		self.device = device
+		self.model_path = model_path
+		if model_path and device != 0:
+			# Device 0 keeps the file name models were saved under before
+			# there could be several Kinects
+			self.model_path = kinectcore.device_file(model_path, device)
+		self.frames = MOTION_FRAMES.labels(device)
+		self.seconds = MOTION_SECONDS.labels(device)
+		self.triggered = MOTION_TRIGGERED.labels(device)
+		self.detector = None
+		self.updated = 0
+		self.updates = 0
+		self.saved = 0
+		self.decimate = MOTION_WARM_DECIMATE
+		self.skipped = 0
+		self.valid = False
+		self.drop = 0
+
+	def _new_detector(self):
+		detector = ZoneDetector(load_depth_filter(self.device), load_zones(self.device))
+		detector.timer = metrics.StageTimer(MOTION_STAGE_SECONDS, [self.device])
+		return detector
+
+	# Runs the detector on a frame, updating the motion metrics
+	def _detect(self, frame):
+		start = time.time()
+		scores = self.detector.process(frame)
+		triggered = self.detector.triggered(scores)
+		self.seconds.observe(time.time() - start)
+		self.frames.inc()
+		if triggered:
+			self.triggered.inc()
+		return scores, triggered
+
+	# Called when the depth stream (re)starts
+	def restart(self):
+		self.valid = False
+		self.drop = 30
+		self.updates = 0
+		if self.detector is not None:
+			age = time.time() - self.updated
+			if age <= MOTION_MODEL_MAX_AGE:
+				logging.info("Resuming motion detection with the current reference")
+				return
+			logging.info("Motion reference is %d s old, rebuilding it", age)
+		self.detector = self.load()
+
+	# Returns (scores, triggered), or None for frames that were dropped, only
+	# went into building the reference or were skipped
+	def process(self, frame, learning=False):
+		if not self.valid:
+			# Drop initial frames that are less than 50% valid
+			self.valid = np.count_nonzero(frame != 2047) >= VALID_THRESHOLD
+			return None
+		elif self.drop:
+			# Drop a few more frames to ensure a stable image
+			self.drop -= 1
+			return None
+
+		detector = self.detector
+		if detector is None or not learning and self.updates < CONVERGED_UPDATES:
+			# Obtain reference image. One taken when detection starts is as
+			# good as a converged one.
+			if detector is None:
+				detector = self.detector = self._new_detector()
+			elif not learning:
+				logging.info("Motion reference has not converged, taking a new one")
+			detector.reset(frame)
+			self.updated = time.time()
+			self.updates = 0 if learning else CONVERGED_UPDATES
+			return None
+
+		if learning:
+			self.skipped += 1
+			if self.skipped < self.decimate:
+				return None
+			self.skipped = 0
+			scores = detector.process(frame)
+			if detector.triggered(scores):
+				# Not settled yet, converge from here
+				self.updates = 0
+			else:
+				self.updates += 1
+			result = scores, []
+		else:
+			result = self._detect(frame)
+			self.updates += 1
+		now = self.updated = time.time()
+		if now - self.saved >= MOTION_MODEL_SAVE:
+			self.save()
+		return result
+
+	def save(self):
+		if not self.model_path or self.detector is None:
+			return
+		self.saved = time.time()
+		# Write a new file and move it in place, so that a crash never leaves
+		# a truncated model
+		tmp = self.model_path + ".tmp"
+		try:
+			with open(tmp, "wb") as fd:
+				np.savez(fd, time=self.updated, **self.detector.model())
+			os.rename(tmp, self.model_path)
+		except (IOError, OSError) as e:
+			logging.warning("Could not save the motion model: %s", e)
+
+	def load(self):
+		if not self.model_path or not os.path.exists(self.model_path):
+			return None
+		try:
+			model = dict(np.load(self.model_path).items())
+			updated = float(model.pop("time"))
+			age = time.time() - updated
+			if age > MOTION_MODEL_MAX_AGE:
+				logging.info("Saved motion model is %d s old, not using it", age)
+				return None
+			detector = self._new_detector()
+			detector.set_model(model)
+		except (IOError, KeyError, ValueError) as e:
+			logging.warning("Could not restore the motion model: %s", e)
+			return None
+		logging.info("Restored the motion model from %s (%d s old)", self.model_path, age)
+		self.updated = updated
+		return detector
+
+# Sensors call on_scores, if set, with the (zone name, motion, lost) scores of
+# a frame every SCORE_INTERVAL seconds while running, and on_detected, if set,
+# right after setting detected. The Detection is left in detection, for the
+# caller to take and release.
+# start() runs detection, and warm() only keeps the reference model up to
+# date, using every decimate-th frame, so that a later start() detects from
+# the first frame. Both can be called again after stop(), and switch modes
+# without restarting the stream.
+class MotionSensor(object):
+
+	def __init__(self, kinect):
+		self.kinect = kinect
+		self.device = kinect.device
+		self.debug = False
+		self.detected = threading.Event()
+		self.keep_running = False
+		self.detecting = False
+		self.thread = None
+		self.stream = None
+		self.engine = MotionEngine(kinect.device)
+		self.detection = None
+		self.on_scores = None
+		self.on_detected = None
+
+	# Depth stream statistics, to tell whether detection keeps up
+	def stats(self):
+		if self.stream is None:
+			return None
+		return self.stream.stats()
+
+	def run(self):
+		stream = self.stream = self.kinect.depth_stream(5)
+		self.engine.restart()
+		try:
+			self._detect(stream)
+		except kinectcore.ConsumerStopped:
+			pass
+		finally:
+			stream.stop()
+			# Saving after a detection would hold up the alarm
+			if not self.detected.is_set():
+				self.engine.save()
+
+	def _detect(self, stream):
+		engine = self.engine
+		last_report = 0
 		for frame in stream:
-			# Get current frame
-			depth, mask = frame_to_depth(frame)
-
-			# Apply depth filter
-			if depth_filter is not None:
-				depth = np.minimum(depth, depth_filter)
-
-			# Blur the depth
-			depth = cv2.GaussianBlur(depth, (0, 0), 2)
-
-			# Booleanize the current reference mask buffer
-			ref_mask = ref_mask_buf > 0.5
-			# Mask out invalid pixels in either image
-			invalid = np.logical_or(mask, ref_mask)
-			# Dilate the mask
-			invalid = cv2.dilate(invalid.astype(np.uint8), dilate_kernel).astype(bool)
-
-			# Count pixels lost vs. the reference image
-			lost = np.logical_and(mask, np.logical_not(ref_mask))
-			lost_count = np.count_nonzero(lost)
-
-			# Mask both arrays
-			masked_ref = np.ma.array(ref, mask=ref_mask)
-			masked_depth = np.ma.array(depth, mask=invalid)
-
-			# Compare, blur the difference
-			delta = np.ma.filled(np.abs(masked_ref - masked_depth), 0)
-			delta = cv2.GaussianBlur(delta, (0, 0), 1)
-			# Mask out pixels under the threshold
-			delta = np.ma.array(ref, mask=(delta < Z_THRESHOLD))
-			# Compute the sum of deltas as a motion value
-			motion = sum(sum(np.ma.filled(delta, 0)))
-
-			# Accumulate into the reference buffer
-			ref = ref * (1 - DECAY_K) + np.where(mask, ref, depth) * DECAY_K
-			ref_mask_buf = ref_mask_buf * (1 - DECAY_K) + mask * DECAY_K
+			if not self.keep_running:
+				return
+			result = engine.process(frame, not self.detecting)
+			if result is None:
+				continue
+			scores, triggered = result
+
+			now = time.time()
+			if self.on_scores is not None and now - last_report >= SCORE_INTERVAL:
+				self.on_scores(score_report(scores))
+				last_report = now
 
 			# Trigger the alarm if motion or excessive lost pixels are detected
-			if motion > MOTION_THRESHOLD or lost_count > LOST_THRESHOLD:
+			# in any zone
+			if triggered:
 				if not self.detected.is_set():
-					logging.info("Motion detected (%d,%d)", motion, lost_count)
-				self.detected.set()
+					for zone, motion, lost_count in triggered:
+						logging.info("Motion detected by Kinect %d in zone %s (%d,%d)",
+						             self.device, zone.name, motion, lost_count)
+					set_detection(self, Detection(self.device, stream.current,
+					                              engine.detector.motion_image(),
+					                              score_report(triggered)))
+					self.detected.set()
+					if self.on_detected is not None:
+						self.on_detected()
 
 			if self.debug:
-				print motion > MOTION_THRESHOLD, lost_count > LOST_THRESHOLD
-				cv2.imshow("Ref", depth_to_img(masked_ref))
-				cv2.imshow("Depth", depth_to_img(masked_depth))
-				cv2.imshow("Delta", delta_to_img(np.ma.filled(delta, 0)))
+				print [zone.name for zone, motion, lost_count in triggered]
+				ref_img, depth_img, delta_img = engine.detector.debug_images()
+				cv2.imshow("Ref", ref_img)
+				cv2.imshow("Depth", depth_img)
+				cv2.imshow("Delta", delta_img)
 				if cv2.waitKey(10) == 27:
 					return
 
+	def is_alive(self):
+		return self.thread is not None and self.thread.is_alive()
+
+	def start(self):
+		self.detected.clear()
+		set_detection(self, None)
+		self._run_as(True)
+
+	def warm(self, decimate=MOTION_WARM_DECIMATE):
+		self.engine.decimate = decimate
+		self._run_as(False)
+
+	def _run_as(self, detecting):
+		if detecting != self.detecting or not self.is_alive():
+			logging.info("Motion detection on Kinect %d %s", self.device,
+			             "started" if detecting else "warming up")
+		self.detecting = detecting
+		if self.is_alive():
+			return
+		self.keep_running = True
+		self.thread = threading.Thread(target=self.run, name="MotionSensor-%d" % self.device)
+		self.thread.start()
+
+	def stop(self):
+		if not self.is_alive():
+			return
+		self.keep_running = False
+		if self.stream is not None:
+			self.stream.interrupt()
+		self.thread.join()
+		logging.info("Motion detection on Kinect %d stopped", self.device)
+
+	def close(self):
+		self.stop()
+
+def set_detection(sensor, detection):
+	old, sensor.detection = sensor.detection, detection
+	if old is not None:
+		old.release()
+
+# Frame size of the depth stream
+DEPTH_SHAPE = (480, 640)
+# Frame slots in the shared memory ring used by ProcessMotionSensor
+RING_SLOTS = 4
+# Worker messages, besides ring slot numbers. WARM goes as (WARM, decimate).
+RESTART = "restart"
+PAUSE = "pause"
+WARM = "warm"
+DETECT = "detect"
+
+def _motion_worker(device, buf, ready, free, events):
+	frames = np.frombuffer(buf, np.uint16).reshape((RING_SLOTS,) + DEPTH_SHAPE)
+	engine = MotionEngine(device)
+	learning = True
+	detection_sent = False
+	last_report = 0
+	while True:
+		msg = ready.get()
+		if msg is None:
+			return
+		elif msg == RESTART:
+			engine.restart()
+			continue
+		elif msg == PAUSE:
+			if not detection_sent:
+				engine.save()
+			continue
+		elif msg == DETECT:
+			learning = False
+			detection_sent = False
+			continue
+		elif isinstance(msg, tuple) and msg[0] == WARM:
+			learning = True
+			detection_sent = False
+			engine.decimate = msg[1]
+			continue
+
+		frame = frames[msg]
+		result = engine.process(frame, learning)
+		if result is not None:
+			scores, triggered = result
+			if triggered:
+				if not detection_sent:
+					# The ring slot is reused once freed, and the queue pickles
+					# later, so copy the frame
+					events.put(("detection", (frame.copy(), engine.detector.motion_image(),
+					                          score_report(triggered))))
+					detection_sent = True
+				events.put(("triggered", score_report(triggered)))
+			now = time.time()
+			if now - last_report >= SCORE_INTERVAL:
+				events.put(("scores", score_report(scores)))
+				events.put(("metrics", worker_metrics(device)))
+				last_report = now
+		free.put(msg)
+
+# Runs the detection in a separate process, so that it does not compete with
+# the rest of the system for the GIL. Depth frames are copied into a shared
+# memory ring and slot numbers are passed to the worker, which hands them back
+# once done. Frames arriving while all slots are busy are dropped.
+# Create this before starting other threads, as the worker is forked here.
+class ProcessMotionSensor(object):
+	def __init__(self, kinect):
+		self.kinect = kinect
+		self.device = kinect.device
+		self.detected = threading.Event()
+		self.keep_running = False
+		self.detecting = False
+		self.stream = None
+		self.thread = None
+		self.dropped = 0
+		self.ring_dropped = RING_DROPPED.labels(kinect.device)
+		self.detection = None
+		self.on_scores = None
+		self.on_detected = None
+
+		self.buf = multiprocessing.RawArray(ctypes.c_uint16, RING_SLOTS * DEPTH_SHAPE[0] * DEPTH_SHAPE[1])
+		self.frames = np.frombuffer(self.buf, np.uint16).reshape((RING_SLOTS,) + DEPTH_SHAPE)
+		self.ready = multiprocessing.Queue()
+		self.free = multiprocessing.Queue()
+		self.events = multiprocessing.Queue()
+		for i in range(RING_SLOTS):
+			self.free.put(i)
+
+		self.process = multiprocessing.Process(target=_motion_worker,
+		                                       name="MotionWorker-%d" % self.device,
+		                                       args=(self.device, self.buf, self.ready, self.free,
+		                                             self.events))
+		self.process.daemon = True
+		self.process.start()
+
+		self.listener = threading.Thread(target=self._listen, name="MotionListener-%d" % self.device)
+		self.listener.daemon = True
+		self.listener.start()
+
+	def stats(self):
+		if self.stream is None:
+			return None
+		stats = self.stream.stats()
+		stats["ring_dropped"] = self.dropped
+		return stats
+
+	def _listen(self):
+		while True:
+			kind, report = self.events.get()
+			if kind == "metrics":
+				for metric, state in zip(WORKER_METRICS, report):
+					metric.load(state)
+				continue
 			if not self.keep_running:
-				return
+				continue
+			if kind == "scores":
+				if self.on_scores is not None:
+					self.on_scores(report)
+				continue
+			if not self.detecting:
+				# Sent before the switch to warming up
+				continue
+			if kind == "detection":
+				set_detection(self, Detection(self.device, *report))
+				continue
+			if not self.detected.is_set():
+				for name, motion, lost_count in report:
+					logging.info("Motion detected by Kinect %d in zone %s (%d,%d)",
+					             self.device, name, motion, lost_count)
+				self.detected.set()
+				if self.on_detected is not None:
+					self.on_detected()
+
+	def _feed(self):
+		stream = self.stream = self.kinect.depth_stream(5)
+		self.ready.put(RESTART)
+		try:
+			for frame in stream:
+				if not self.keep_running:
+					return
+				try:
+					slot = self.free.get_nowait()
+				except Queue.Empty:
+					self.dropped += 1
+					self.ring_dropped.inc()
+					continue
+				self.frames[slot] = frame
+				self.ready.put(slot)
+		except kinectcore.ConsumerStopped:
+			pass
+		finally:
+			stream.stop()
+			self.ready.put(PAUSE)
+
+	def is_alive(self):
+		return self.thread is not None and self.thread.is_alive()
 
 	def start(self):
+		self.detected.clear()
+		set_detection(self, None)
+		self._run_as(True)
+
+	def warm(self, decimate=MOTION_WARM_DECIMATE):
+		self._run_as(False, decimate)
+
+	# The mode goes through the ring queue, so the worker switches at the
+	# right frame
+	def _run_as(self, detecting, decimate=None):
+		if detecting != self.detecting or not self.is_alive():
+			logging.info("Motion detection on Kinect %d %s", self.device,
+			             "started" if detecting else "warming up")
+		self.detecting = detecting
+		self.ready.put(DETECT if detecting else (WARM, decimate))
 		if self.is_alive():
 			return
-		logging.info("Motion detection started")
 		self.keep_running = True
-		threading.Thread.start(self)
+		self.thread = threading.Thread(target=self._feed, name="MotionSensor-%d" % self.device)
+		self.thread.start()
 
 	def stop(self):
 		if not self.is_alive():
 			return
 		self.keep_running = False
-		self.join()
-		logging.info("Motion detection stopped")
+		if self.stream is not None:
+			self.stream.interrupt()
+		self.thread.join()
+		logging.info("Motion detection on Kinect %d stopped", self.device)
+
+	def close(self):
+		self.stop()
+		self.ready.put(None)
+		self.process.join()
+
+def create_sensor(kinect):
+	if MOTION_PROCESS:
+		return ProcessMotionSensor(kinect)
+	return MotionSensor(kinect)
+
+# The sensors of several Kinects, fused into one with the same interface.
+# Motion detected by any of them sets detected, and moves that sensor's
+# Detection to detection. on_scores is called with the device number and
+# its scores.
+class MotionSensors(object):
+	def __init__(self, sensors):
+		self.sensors = sensors
+		self.lock = threading.Lock()
+		self.detected = threading.Event()
+		self.detection = None
+		self.on_scores = None
+		self.on_detected = None
+		for sensor in sensors:
+			sensor.on_scores = functools.partial(self._scores, sensor.device)
+			sensor.on_detected = functools.partial(self._detected, sensor)
+
+	def _scores(self, device, scores):
+		if self.on_scores is not None:
+			self.on_scores(device, scores)
+
+	def _detected(self, sensor):
+		with self.lock:
+			if self.detected.is_set():
+				return
+			detection, sensor.detection = sensor.detection, None
+			set_detection(self, detection)
+			self.detected.set()
+		if self.on_detected is not None:
+			self.on_detected()
+
+	def is_alive(self):
+		return any(sensor.is_alive() for sensor in self.sensors)
+
+	def start(self):
+		with self.lock:
+			self.detected.clear()
+			set_detection(self, None)
+		for sensor in self.sensors:
+			sensor.start()
+
+	def warm(self, decimate=MOTION_WARM_DECIMATE):
+		for sensor in self.sensors:
+			sensor.warm(decimate)
+
+	def stop(self):
+		for sensor in self.sensors:
+			sensor.stop()
+
+	# Stops the sensors for good, letting worker processes save their model
+	def close(self):
+		for sensor in self.sensors:
+			sensor.close()
+
+# Call before starting other threads, see ProcessMotionSensor
+def create_sensors(kinects):
+	return MotionSensors([create_sensor(kinect) for kinect in kinects])
 
 if __name__ == "__main__":
 	kinect = kinectcore.KinectStreamer()
@@ -147,6 +1113,8 @@ if __name__ == "__main__":
 	try:
 		motion = MotionSensor(kinect)
 		motion.debug = True
+		motion.keep_running = True
+		motion.detecting = True
 		motion.run()
 	finally:
 		kinect.stop()
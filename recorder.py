@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+# Keeps the last RECORD_PREROLL seconds of video and depth as compressed
+# frames in memory, and writes them to a clip directory when triggered, along
+# with everything up to RECORD_POSTROLL seconds after the last trigger.
+#
+# A clip directory holds video.mjpeg (concatenated JPEG frames) with
+# video_ts.npy, and depth.dpk (see depthfile.py), so depth can be fed back
+# through the motion pipeline with REPLAY_PATH.
+
+import collections
+import cv2
+import logging
+import numpy as np
+import os
+import Queue
+import threading
+import time
+import zlib
+
+import depthfile
+import kinectcore
+import metrics
+import render
+
+from config import *
+
+# Quality of recorded video frames
+VIDEO_QUALITY = 85
+# Live frames waiting to be written, per clip, before new ones are dropped
+WRITE_BACKLOG = 100
+
+CLIPS = metrics.Counter("recorder_clips_total", "Clips written", ["device", "reason"])
+CLIP_FAILURES = metrics.Counter("recorder_clip_failures_total", "Clips that could not be written",
+                                ["device", "reason"])
+DROPPED = metrics.Counter("recorder_dropped_total", "Frames a clip writer fell behind on",
+                          ["device", "stream"])
+RING_BYTES = metrics.Gauge("recorder_ring_bytes", "Compressed frame data held",
+                           ["device", "stream"])
+
+# Compressed (time, timestamp, data) frames, evicting the oldest to stay
+# within max_bytes and max_seconds
+class ClipRing(object):
+	def __init__(self, max_bytes, max_seconds):
+		self.max_bytes = max_bytes
+		self.max_seconds = max_seconds
+		self.items = collections.deque()
+		self.bytes = 0
+
+	def append(self, item):
+		self.items.append(item)
+		self.bytes += len(item[2])
+		oldest = item[0] - self.max_seconds
+		while self.items and (self.bytes > self.max_bytes or self.items[0][0] < oldest):
+			self.bytes -= len(self.items.popleft()[2])
+
+	def snapshot(self):
+		return list(self.items)
+
+def compress_video(frame):
+	return render.encode_jpeg(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), VIDEO_QUALITY)
+
+def compress_depth(frame):
+	return zlib.compress(np.ascontiguousarray(frame).tostring(), 1)
+
+class VideoClipStream(object):
+	def __init__(self, path, shape):
+		self.path = path
+		self.fd = open(os.path.join(path, "video.mjpeg"), "wb")
+		self.ts = []
+
+	def write(self, item):
+		self.fd.write(item[2])
+		self.ts.append(item[:2])
+
+	def close(self):
+		self.fd.close()
+		np.save(os.path.join(self.path, "video_ts.npy"), np.array(self.ts).reshape(-1, 2))
+
+class DepthClipStream(object):
+	def __init__(self, path, shape):
+		self.shape = shape
+		self.writer = depthfile.DepthWriter(os.path.join(path, depthfile.FILENAME), shape)
+
+	def write(self, item):
+		frame = np.frombuffer(zlib.decompress(item[2]), np.uint16).reshape(self.shape)
+		if INVERT_KINECT:
+			frame = frame[::-1, ::-1] # Store in device orientation
+		self.writer.write(frame, *item[:2])
+
+	def close(self):
+		self.writer.close()
+
+CLIP_STREAMS = {
+	"video": VideoClipStream,
+	"depth": DepthClipStream,
+}
+
+# Writes one clip: the frames that were in the rings when it was triggered,
+# then live frames until its end time, which triggers can push back.
+class ClipWriter(threading.Thread):
+	def __init__(self, recorder, path, reason, until, backlog):
+		threading.Thread.__init__(self, name="ClipWriter")
+		self.recorder = recorder
+		self.path = path
+		self.reason = reason
+		self.until = until
+		self.backlog = backlog
+		self.queue = Queue.Queue(WRITE_BACKLOG)
+		self.closing = False
+
+	# Called with the recorder lock held
+	def put(self, name, item):
+		try:
+			self.queue.put_nowait((name, item))
+		except Queue.Full:
+			DROPPED.labels(self.recorder.device, name).inc()
+
+	def run(self):
+		streams = {}
+		try:
+			os.makedirs(self.path)
+			logging.info("Recording %s clip to %s", self.reason, self.path)
+			for name, items in self.backlog.items():
+				for item in items:
+					self._write(streams, name, item)
+			self.backlog = None
+			while True:
+				try:
+					name, item = self.queue.get(timeout=0.5)
+				except Queue.Empty:
+					with self.recorder.lock:
+						if time.time() > self.until:
+							self.closing = True
+							break
+					continue
+				self._write(streams, name, item)
+			# Nothing is added once closing
+			while not self.queue.empty():
+				self._write(streams, *self.queue.get())
+			self._close(streams)
+		except OSError:
+			logging.exception("Cannot record clip to %s", self.path)
+			CLIP_FAILURES.labels(self.recorder.device, self.reason).inc()
+		except Exception:
+			logging.exception("Clip recording failed")
+			CLIP_FAILURES.labels(self.recorder.device, self.reason).inc()
+		else:
+			CLIPS.labels(self.recorder.device, self.reason).inc()
+			logging.info("Recorded clip %s", self.path)
+		finally:
+			# The next trigger starts a new writer, even if this one failed
+			self.closing = True
+			self.backlog = None
+			self._close(streams)
+
+	def _close(self, streams):
+		while streams:
+			streams.popitem()[1].close()
+
+	def _write(self, streams, name, item):
+		if name not in streams:
+			streams[name] = CLIP_STREAMS[name](self.path, self.recorder.shapes[name])
+		streams[name].write(item)
+
+# Compression runs in the recorder's own consumer threads, so the streamer
+# is never held up: when they fall behind, the consumers just skip frames.
+# The Kinect streams stay open while the recorder runs.
+class ClipRecorder(object):
+	def __init__(self, kinect, path=RECORD_PATH):
+		self.kinect = kinect
+		self.device = kinect.device
+		self.path = path
+		self.lock = threading.Lock()
+		self.rings = {}
+		self.shapes = {}
+		self.threads = []
+		self.writer = None
+		self.keep_running = False
+
+	def is_alive(self):
+		return any(thread.is_alive() for thread in self.threads)
+
+	def start(self):
+		if self.is_alive():
+			return
+		self.keep_running = True
+		streams = [
+			("video", self.kinect.video_stream(RECORD_DECIMATE), compress_video),
+			("depth", self.kinect.depth_stream(RECORD_DECIMATE), compress_depth),
+		]
+		self.threads = []
+		for name, stream, compress in streams:
+			ring = self.rings[name] = ClipRing(RECORD_MEMORY / 2, RECORD_PREROLL)
+			RING_BYTES.labels(self.device, name).set_function(lambda ring=ring: ring.bytes)
+			thread = threading.Thread(target=self._capture,
+			                          name="Recorder-%d-%s" % (self.device, name),
+			                          args=(name, stream, compress))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+		logging.info("Clip recorder for Kinect %d started", self.device)
+
+	def _capture(self, name, stream, compress):
+		try:
+			while self.keep_running:
+				frame = stream.next_frame()
+				self.shapes[name] = frame.data.shape
+				item = (frame.time, frame.timestamp, compress(frame.data))
+				with self.lock:
+					self.rings[name].append(item)
+					writer = self.writer
+					if writer is not None and not writer.closing and item[0] <= writer.until:
+						writer.put(name, item)
+		except kinectcore.StreamerDied:
+			logging.warning("Clip recorder lost the %s stream of Kinect %d", name, self.device)
+		finally:
+			stream.stop()
+
+	# The (time, timestamp, data) frame of a stream held in memory that is
+	# closest to time t, or None
+	def nearest(self, name, t):
+		with self.lock:
+			ring = self.rings.get(name)
+			if ring is None or not ring.items:
+				return None
+			return min(ring.items, key=lambda item: abs(item[0] - t))
+
+	# Record a clip, or extend the one being recorded
+	def trigger(self, reason):
+		with self.lock:
+			now = time.time()
+			until = now + RECORD_POSTROLL
+			if self.writer is not None and not self.writer.closing:
+				self.writer.until = max(self.writer.until, until)
+				return
+			backlog = dict((name, ring.snapshot()) for name, ring in self.rings.items())
+			clip = os.path.join(self.path, "%s-%03d-%s" % (
+				time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), now * 1000 % 1000, reason))
+			self.writer = ClipWriter(self, clip, reason, until, backlog)
+			self.writer.start()
+
+	def stop(self):
+		self.keep_running = False
+		for thread in self.threads:
+			thread.join()
+		with self.lock:
+			writer = self.writer
+			if writer is not None:
+				# Finish the clip with what has been recorded so far
+				writer.until = 0
+		if writer is not None:
+			writer.join()
+		logging.info("Clip recorder for Kinect %d stopped", self.device)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# JPEG rendering of Kinect frames for the web interface. Frames are shrunk to
+# the output size first, depth is colored through a lookup table and the
+# result is encoded with a single cv2.imencode call.
+
+import cv2
+import numpy as np
+from PIL import Image, ImageEnhance, ImageOps
+import StringIO
+
+import depthlut
+
+# Depth colors in OpenCV (BGR) order
+RAW_TO_BGR = np.ascontiguousarray(depthlut.RAW_TO_RGB[:, ::-1])
+
+SIZE = (480, 360)
+QUALITY = 75
+
+def encode_jpeg(img, quality=QUALITY):
+	ok, data = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+	if not ok:
+		raise ValueError("JPEG encoding failed")
+	return data.tostring()
+
+def render_depth(frame, size=SIZE, quality=QUALITY):
+	# Nearest neighbor, so invalid readings are not blended into valid ones
+	frame = cv2.resize(frame, size, interpolation=cv2.INTER_NEAREST)
+	return encode_jpeg(depthlut.lookup(RAW_TO_BGR, frame), quality)
+
+def render_video(frame, size=SIZE, quality=QUALITY):
+	frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+	# Equalize each channel, as ImageOps.equalize does, swapping to BGR
+	r, g, b = cv2.split(frame)
+	img = cv2.merge([cv2.equalizeHist(c) for c in (b, g, r)])
+	return encode_jpeg(img, quality)
+
+# Motion map (see motion.py) colored over a dimmed grayscale depth image
+def render_heatmap(depth, motion_map, size=SIZE, quality=QUALITY):
+	depth = cv2.resize(depth, size, interpolation=cv2.INTER_NEAREST)
+	gray = depthlut.lookup(depthlut.RAW_TO_DISPLAY, depth) // 2
+	img = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+	# Area averaging turns the map into the share of moving pixels
+	heat = cv2.resize(motion_map.astype(np.float32), size, interpolation=cv2.INTER_AREA)
+	peak = heat.max()
+	if peak > 0:
+		heat = (heat * (255 / peak)).astype(np.uint8)
+		colored = cv2.applyColorMap(heat, cv2.COLORMAP_JET)
+		moving = heat > 0
+		img[moving] = colored[moving]
+	return encode_jpeg(img, quality)
+
+# Previous PIL based implementation, kept for comparison in bench.py
+
+def pil_render_depth(frame):
+	frame = depthlut.lookup(depthlut.RAW_TO_DISPLAY, frame)
+	im = Image.fromarray(frame, "L")
+	im = im.resize(SIZE, Image.BILINEAR)
+	im.putpalette(depthlut.DISPLAY_PALETTE)
+	im = im.convert("RGB")
+	im = ImageEnhance.Sharpness(im).enhance(1)
+	fd = StringIO.StringIO()
+	im.save(fd, "JPEG", quality=QUALITY)
+	return fd.getvalue()
+
+def pil_render_video(frame):
+	im = Image.fromarray(np.ascontiguousarray(frame), "RGB")
+	im = ImageOps.equalize(im)
+	im = im.resize(SIZE, Image.BILINEAR)
+	fd = StringIO.StringIO()
+	im.save(fd, "JPEG", quality=QUALITY)
+	return fd.getvalue()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+# Frame source that replays recorded footage through KinectStreamer, and a
+# tool to record it. A recording is a directory holding depth.npy and/or
+# video.npy (one frame per row, in device orientation) plus depth_ts.npy /
+# video_ts.npy with one (receive time, device timestamp) row per frame.
+# Depth may instead be stored in depth.dpk (see depthfile.py), which carries
+# its own timing; recordings made here use it.
+
+import logging
+import numpy as np
+import os
+import sys
+import threading
+import time
+
+import depthfile
+import kinectcore
+
+from config import *
+
+# Frame rate assumed for recordings without timing information
+DEFAULT_FPS = 30.0
+
+def compact_path(path, name):
+	if name == "depth":
+		return os.path.join(path, depthfile.FILENAME)
+	return None
+
+def has_stream(path, name):
+	compact = compact_path(path, name)
+	return (os.path.exists(os.path.join(path, name + ".npy")) or
+	        (compact is not None and os.path.exists(compact)))
+
+# Frames of a recorded stream, from the .npy file if there is one. Indexing
+# frames gives arrays that are only valid until the next frame is read.
+class ReplayStream(object):
+	def __init__(self, path, name):
+		npy = os.path.join(path, name + ".npy")
+		compact = compact_path(path, name)
+		if compact is not None and not os.path.exists(npy) and os.path.exists(compact):
+			self.frames = depthfile.DepthReader(compact)
+			count = len(self.frames)
+			self.times = self.frames.times - (self.frames.times[0] if count else 0)
+			self.timestamps = self.frames.timestamps.astype(np.uint32)
+		else:
+			self.frames = np.load(npy, mmap_mode="r")
+			count = len(self.frames)
+			try:
+				ts = np.load(os.path.join(path, name + "_ts.npy"))
+				self.times = ts[:, 0] - ts[0, 0]
+				self.timestamps = ts[:, 1].astype(np.uint32)
+			except IOError:
+				self.times = None
+		if self.times is None or (count > 1 and not self.times[-1]):
+			# No timing information
+			self.times = np.arange(count) / DEFAULT_FPS
+			self.timestamps = np.zeros(count, np.uint32)
+		if count > 1:
+			self.period = self.times[-1] / (count - 1)
+		else:
+			self.period = 1 / DEFAULT_FPS
+		self.pos = 0
+		self.base = 0
+		self.started = False
+		self.exhausted = count == 0
+
+	def next_time(self):
+		return self.base + self.times[self.pos]
+
+	def rebase(self, clock):
+		# Continue from the current position as if it was due now
+		self.base = clock - self.times[self.pos]
+
+	def advance(self, loop):
+		self.pos += 1
+		if self.pos >= len(self.frames):
+			if loop:
+				self.base += self.times[-1] + self.period
+				self.pos = 0
+			else:
+				self.exhausted = True
+
+class ReplaySource(object):
+	def __init__(self, path, realtime=True, loop=False, speed=1.0):
+		self.path = path
+		self.realtime = realtime
+		self.loop = loop
+		self.speed = speed
+		self.streams = {}
+		for name in ("depth", "video"):
+			if has_stream(path, name):
+				self.streams[name] = ReplayStream(path, name)
+		if not self.streams:
+			raise IOError("No recording found in %s" % path)
+		self.clock = 0
+		self.wall_base = None
+
+	def open(self, depth_cb, video_cb):
+		self.callbacks = {"depth": depth_cb, "video": video_cb}
+		logging.info("Replaying recording from %s", self.path)
+
+	def close(self):
+		pass
+
+	def _start(self, name):
+		stream = self.streams.get(name)
+		if stream is None:
+			logging.warning("Recording has no %s stream", name)
+			return
+		stream.started = True
+		stream.rebase(self.clock)
+	def _stop(self, name):
+		if name in self.streams:
+			self.streams[name].started = False
+
+	def start_depth(self):
+		self._start("depth")
+	def stop_depth(self):
+		self._stop("depth")
+	def start_video(self):
+		self._start("video")
+	def stop_video(self):
+		self._stop("video")
+
+	def set_led(self, ledstate):
+		pass
+
+	def _now(self):
+		return (time.time() - self.wall_base) * self.speed
+
+	def runloop(self, body):
+		self.wall_base = time.time() - self.clock / self.speed
+		try:
+			while True:
+				body()
+				active = [(n, s) for n, s in self.streams.items()
+				          if s.started and not s.exhausted]
+				if not active:
+					if any(s.started for s in self.streams.values()):
+						raise kinectcore.SourceExhausted("End of recording")
+					# Nothing to play, wait for the streamer to notice
+					time.sleep(0.01)
+					continue
+				name, stream = min(active, key=lambda i: i[1].next_time())
+				due = stream.next_time()
+				if self.realtime:
+					wait = (due - self._now()) / self.speed
+					if wait > 0:
+						# Keep calling body() while waiting on long gaps
+						time.sleep(min(wait, 0.1))
+						if wait > 0.1:
+							continue
+				self.clock = max(self.clock, due)
+				data = np.asarray(stream.frames[stream.pos])
+				self.callbacks[name](self, data, int(stream.timestamps[stream.pos]))
+				stream.advance(self.loop)
+		except kinectcore.StopRunloop:
+			pass
+		finally:
+			if self.realtime:
+				self.clock = max(self.clock, self._now())
+
+def record(path, count):
+	kinect = kinectcore.KinectStreamer(kinectcore.FreenectSource())
+	if not os.path.isdir(path):
+		os.makedirs(path)
+
+	def frames(name, stream):
+		try:
+			for i in range(count):
+				frame = stream.next_frame()
+				data = frame.data
+				if INVERT_KINECT:
+					data = data[::-1, ::-1] # Store in device orientation
+				yield frame, data
+		finally:
+			stream.stop()
+		logging.info("Recorded %d %s frames", count, name)
+
+	def capture_video(stream):
+		out = np.lib.format.open_memmap(os.path.join(path, "video.npy"),
+		                                "w+", np.uint8, (count, 480, 640, 3))
+		ts = np.zeros((count, 2))
+		for i, (frame, data) in enumerate(frames("video", stream)):
+			out[i] = data
+			ts[i] = frame.time, frame.timestamp
+		out.flush()
+		np.save(os.path.join(path, "video_ts.npy"), ts)
+
+	def capture_depth(stream):
+		writer = depthfile.DepthWriter(os.path.join(path, depthfile.FILENAME))
+		try:
+			for frame, data in frames("depth", stream):
+				writer.write(data, frame.time, frame.timestamp)
+		finally:
+			writer.close()
+
+	kinect.start()
+	try:
+		threads = [
+			threading.Thread(target=capture_depth, args=(kinect.depth_stream(queue_size=30),)),
+			threading.Thread(target=capture_video, args=(kinect.video_stream(queue_size=30),)),
+		]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+	finally:
+		kinect.stop()
+
+if __name__ == "__main__":
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+	if len(sys.argv) != 3:
+		print "Usage: %s <output directory> <frame count>" % sys.argv[0]
+		sys.exit(1)
+	record(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+# Single threaded event loop (asyncore) for long lived client connections,
+# such as MJPEG streams. Other threads hand work to it with call_soon().
+
+import asyncore
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+class Waker(asyncore.file_dispatcher):
+	def writable(self):
+		return False
+
+	def handle_read(self):
+		try:
+			self.recv(4096)
+		except OSError:
+			pass
+
+class StreamLoop(threading.Thread):
+	def __init__(self):
+		threading.Thread.__init__(self, name="StreamLoop")
+		self.daemon = True
+		self.map = {}
+		self.lock = threading.Lock()
+		self.calls = collections.deque()
+		self.timers = []
+		self.timer_seq = itertools.count()
+		self.keep_running = True
+		rfd, self.wake_fd = os.pipe()
+		# A full pipe already means a wakeup is pending, so never block on it
+		for fd in (rfd, self.wake_fd):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		Waker(rfd, map=self.map)
+		os.close(rfd) # file_dispatcher keeps a dup
+		self.channels = set()
+
+	# Run fn(*args) in the loop thread. Safe to call from any thread. Calls
+	# made once the loop is stopping are dropped.
+	def call_soon(self, fn, *args):
+		with self.lock:
+			if not self.keep_running:
+				return
+			wake = not self.calls
+			self.calls.append((fn, args))
+			if wake:
+				self._wake()
+
+	# Run fn(*args) in the loop thread after delay seconds. Safe to call from
+	# any thread.
+	def call_later(self, delay, fn, *args):
+		self.call_soon(self._add_timer, time.time() + delay, fn, args)
+
+	def _add_timer(self, when, fn, args):
+		heapq.heappush(self.timers, (when, next(self.timer_seq), fn, args))
+
+	# Called with the lock held, so that the pipe is not closed under it
+	def _wake(self):
+		if not self.keep_running:
+			return
+		try:
+			os.write(self.wake_fd, "x")
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def _run_calls(self):
+		with self.lock:
+			calls, self.calls = self.calls, collections.deque()
+		for fn, args in calls:
+			self._call(fn, args)
+
+	def _run_timers(self):
+		now = time.time()
+		while self.timers and self.timers[0][0] <= now:
+			when, seq, fn, args = heapq.heappop(self.timers)
+			self._call(fn, args)
+
+	def _call(self, fn, args):
+		try:
+			fn(*args)
+		except Exception:
+			logging.exception("Stream loop call failed")
+
+	def run(self):
+		try:
+			while self.keep_running:
+				timeout = 1
+				if self.timers:
+					timeout = min(timeout, max(0, self.timers[0][0] - time.time()))
+				asyncore.loop(timeout=timeout, use_poll=True, map=self.map, count=1)
+				self._run_calls()
+				self._run_timers()
+		finally:
+			for channel in list(self.channels):
+				channel.handle_close()
+			asyncore.close_all(self.map)
+
+	def stop(self):
+		if not self.is_alive():
+			return
+		with self.lock:
+			self._wake()
+			self.keep_running = False
+		self.join()
+		os.close(self.wake_fd)
+
+# A client connection that is only written to. At most one message waits
+# behind the one being sent: if the client falls behind, newer messages
+# replace the waiting one, so slow clients skip data instead of buffering it.
+class StreamChannel(asyncore.dispatcher):
+	def __init__(self, loop, sock, on_close=None):
+		asyncore.dispatcher.__init__(self, sock, map=loop.map)
+		self.loop = loop
+		self.on_close = on_close
+		self.out = None
+		self.offset = 0
+		self.waiting = None
+		self.sent = 0
+		self.dropped = 0
+		self.closed = False
+		self.started = None
+		self.last_progress = time.time()
+		loop.channels.add(self)
+
+	# Loop thread only
+	def push(self, data):
+		if self.closed:
+			return
+		if self.out is None:
+			self._begin(data)
+		else:
+			if self.waiting is not None:
+				self.dropped += 1
+			self.waiting = data
+
+	def _begin(self, data):
+		self.out = data
+		self.offset = 0
+		self.started = time.time()
+
+	def busy(self):
+		return self.out is not None
+
+	# Called once each message has been fully sent
+	def message_sent(self, size, duration):
+		pass
+
+	def writable(self):
+		return self.out is not None
+
+	def handle_write(self):
+		sent = self.send(buffer(self.out, self.offset))
+		if not sent:
+			return
+		now = time.time()
+		self.last_progress = now
+		self.offset += sent
+		self.sent += sent
+		if self.offset >= len(self.out):
+			self.message_sent(len(self.out), now - self.started)
+			waiting, self.waiting = self.waiting, None
+			self.out = None
+			if waiting is not None:
+				self._begin(waiting)
+
+	def handle_read(self):
+		# Nothing is expected from the client; this notices disconnects
+		self.recv(4096)
+
+	def handle_close(self):
+		if self.closed:
+			return
+		self.closed = True
+		self.loop.channels.discard(self)
+		self.close()
+		if self.on_close is not None:
+			self.on_close(self)
+
+	def handle_error(self):
+		logging.exception("Stream client error")
+		self.handle_close()
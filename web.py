@@ -2,51 +2,457 @@
 
 import base64
 import BaseHTTPServer, SocketServer
-import cv
+import collections
+import gzip
+import hashlib
+import json
 import logging
 import mimetypes
-import numpy as np
-from PIL import Image, ImageEnhance, ImageOps
-import select
+import os
+import re
+import socket
 import StringIO
 import threading
-import urllib2
+import time
 import urlparse
 
 import debug
 import kinectcore
+import metrics
+import render
+import streamloop
 
 from config import *
 
-color_palette=[]
-for i in range(255):
-	v = int(i* 6 * 1.0)
-	h = v >> 8
-	h = h%6
-	l = v & 0xff
-	if h == 0:
-		color_palette += (255,0,255-l)
-	elif h == 1:
-		color_palette += (255,l,0)
-	elif h == 2:
-		color_palette += (255-l,255,0)
-	elif h == 3:
-		color_palette += (0,255,l)
-	elif h == 4:
-		color_palette += (0,255-l,255)
-	elif h == 5:
-		color_palette += (l,0,255)
-color_palette += (0,0,0)
+ENCODE_SECONDS = metrics.Histogram("web_encode_seconds", "Time to render and encode a frame",
+                                   ["device", "stream"])
+STREAM_FRAMES = metrics.Counter("web_stream_frames_total", "Encoded frames handed to clients",
+                                ["device", "stream"])
+STREAM_LATE = metrics.Counter("web_stream_late_frames_total",
+                              "Frames that arrived while a client was still sending the last one",
+                              ["device", "stream"])
+STREAM_CLIENTS = metrics.Gauge("web_stream_subscribers", "Subscribers of each stream",
+                               ["device", "stream"])
+EVENT_CLIENTS = metrics.Gauge("web_event_clients", "Connected /events clients")
+SNAPSHOTS = metrics.Counter("web_snapshots_total", "Snapshot requests", ["device", "stream", "cache"])
 
+# Output variants are (size, quality) pairs
+DEFAULT_VARIANT = ((480, 360), 75)
+STREAM_WIDTHS = (160, 240, 320, 480, 640)
+
+def stream_variant(width, quality):
+	# Snap to a few sizes and qualities so that clients can share encodes
+	width = min(STREAM_WIDTHS, key=lambda w: abs(w - width))
+	quality = min(95, max(20, int(round(quality / 5.0)) * 5))
+	return (width, width * 3 // 4), quality
+
+# Subscribers have a thread safe put(data), and a variant and wants(now) that
+# tell the broadcaster which frames to render for them, and how. Those with
+# mjpeg set are handed multipart MJPEG chunks instead of bare JPEG data.
+class BroadcastSubscriber(object):
+	variant = DEFAULT_VARIANT
+	mjpeg = False
+
+	def __init__(self, broadcaster):
+		self.broadcaster = broadcaster
+		self.queue = kinectcore.FrameQueue()
+		self.active = True
+
+	def wants(self, now):
+		return True
+
+	def put(self, data):
+		self.queue.put(data)
+
+	def __iter__(self):
+		return self
+	def next(self):
+		return self.queue.get()
+
+	def stop(self):
+		if self.active:
+			self.broadcaster.unsubscribe(self)
+			self.active = False
+
+# Keeps a broadcaster rendering frames for snapshots, often enough for the
+# cache to stay fresh, until no snapshot has been requested for a while.
+class SnapshotSubscriber(object):
+	variant = DEFAULT_VARIANT
+	mjpeg = False
+
+	def __init__(self, broadcaster):
+		self.broadcaster = broadcaster
+		self.until = 0
+		self.next_time = 0
+
+	def linger(self):
+		self.until = time.time() + SNAPSHOT_LINGER
+
+	def wants(self, now):
+		if now > self.until:
+			self.broadcaster.unsubscribe(self)
+			return False
+		if now < self.next_time:
+			return False
+		self.next_time = now + SNAPSHOT_MAX_AGE / 2
+		return True
+
+	def put(self, data):
+		with self.broadcaster.updated:
+			if isinstance(data, Exception):
+				self.broadcaster.unsubscribe(self)
+			self.broadcaster.updated.notify_all()
+
+def mjpeg_part(data):
+	return ("--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+	        % (RequestHandler.MIMETAG, len(data))) + data
+
+# Renders each frame of a Kinect stream to JPEG data, and the MJPEG chunk
+# holding it, once per variant, and hands them to every subscriber that wants
+# them. The Kinect stream is only open while there are subscribers. The
+# decimation sets the maximum frame rate. The latest frame of each variant is
+# kept for snapshots.
+class StreamBroadcaster(object):
+	def __init__(self, kinect, kind, render, decimate=3):
+		self.kinect = kinect
+		self.device = kinect.device
+		self.kind = kind
+		self.render = render
+		self.decimate = decimate
+		self.lock = threading.RLock()
+		self.subscribers = set()
+		self.thread = None
+		self.latest = {}
+		self.updated = threading.Condition(self.lock)
+		self.snapshots = SnapshotSubscriber(self)
+		self.encode_time = ENCODE_SECONDS.labels(self.device, kind)
+		self.frames_sent = STREAM_FRAMES.labels(self.device, kind)
+		STREAM_CLIENTS.labels(self.device, kind).set_function(lambda: len(self.subscribers))
+
+	# Returns the latest frame as JPEG data, at most SNAPSHOT_MAX_AGE seconds
+	# old, or None if no frame arrives in time.
+	def snapshot(self, timeout=5):
+		variant = self.snapshots.variant
+		self.snapshots.linger()
+		deadline = time.time() + timeout
+		started = False
+		with self.lock:
+			while True:
+				now = time.time()
+				frame_time, data = self.latest.get(variant, (0, None))
+				if now - frame_time <= SNAPSHOT_MAX_AGE:
+					SNAPSHOTS.labels(self.device, self.kind, "miss" if started else "hit").inc()
+					return data
+				if now >= deadline:
+					return None
+				if self.snapshots not in self.subscribers:
+					if started:
+						# The stream failed
+						return None
+					started = True
+					self.snapshots.next_time = 0
+					self.subscribers.add(self.snapshots)
+					self._start()
+				self.updated.wait(deadline - now)
+
+	def subscribe(self, subscriber=None):
+		if subscriber is None:
+			subscriber = BroadcastSubscriber(self)
+		with self.lock:
+			self.subscribers.add(subscriber)
+			self._start()
+		return subscriber
+
+	def _start(self):
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._run,
+			                               name="Broadcast-%d-%s" % (self.device, self.kind))
+			self.thread.daemon = True
+			self.thread.start()
+
+	def unsubscribe(self, subscriber):
+		with self.lock:
+			self.subscribers.discard(subscriber)
+
+	def _run(self):
+		if self.kind == "video":
+			stream = self.kinect.video_stream(self.decimate)
+		else:
+			stream = self.kinect.depth_stream(self.decimate)
+		try:
+			for frame in stream:
+				with self.lock:
+					if not self.subscribers:
+						self.thread = None
+						return
+					subscribers = list(self.subscribers)
+				now = time.time()
+				encoded = {}
+				parts = {}
+				for subscriber in subscribers:
+					if not subscriber.wants(now):
+						continue
+					variant = subscriber.variant
+					if variant not in encoded:
+						start = time.time()
+						encoded[variant] = data = self.render(frame, *variant)
+						self.encode_time.observe(time.time() - start)
+						self.latest[variant] = now, data
+					data = encoded[variant]
+					if subscriber.mjpeg:
+						if variant not in parts:
+							parts[variant] = mjpeg_part(data)
+						data = parts[variant]
+					subscriber.put(data)
+					self.frames_sent.inc()
+		except kinectcore.StreamerDied as e:
+			# The streamer stopped or restarted
+			logging.info("%s broadcast of Kinect %d ended: %s", self.kind, self.device, e)
+			self._fail(e)
+		except Exception as e:
+			logging.exception("%s broadcast of Kinect %d failed", self.kind, self.device)
+			self._fail(e)
+		finally:
+			stream.stop()
+
+	# Passes the exception on to the subscribers
+	def _fail(self, e):
+		with self.lock:
+			self.thread = None
+			for subscriber in list(self.subscribers):
+				subscriber.put(e)
+
+# Steps down from the requested output for clients that can't keep up, as
+# (size factor, quality factor)
+ADAPT_LEVELS = [(1.0, 1.0), (1.0, 0.7), (0.67, 0.7), (0.5, 0.6), (0.33, 0.5)]
+
+# Socket send buffer of MJPEG clients
+STREAM_SEND_BUFFER = 65536
+
+# MJPEG client that adapts to its connection. Frames that arrive while the
+# previous one is still being sent count as late; after a few in a row the
+# client steps down a level, and it steps back up after keeping up for a
+# while. The frame rate is also capped to what the measured throughput can
+# carry. Clients that make no progress at all are disconnected.
+class MJPEGClient(streamloop.StreamChannel):
+	mjpeg = True
+	LATE_LIMIT = 3
+	GOOD_LIMIT = 20
+
+	def __init__(self, loop, sock, broadcaster, fps=2, width=480, quality=75):
+		# Keep the kernel from buffering seconds of video, so that slow
+		# clients show up as late frames here
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, STREAM_SEND_BUFFER)
+		streamloop.StreamChannel.__init__(self, loop, sock, self._closed)
+		self.broadcaster = broadcaster
+		self.late_frames = STREAM_LATE.labels(broadcaster.device, broadcaster.kind)
+		self.fps = fps
+		self.width = width
+		self.quality = quality
+		self.level = 0
+		self.late = 0
+		self.good = 0
+		self.rate = None
+		self.frame_size = None
+		self.next_time = 0
+		self._set_level(0)
+
+	def _set_level(self, level):
+		self.level = level
+		size, quality = ADAPT_LEVELS[level]
+		self.variant = stream_variant(self.width * size, self.quality * quality)
+
+	# Called from the broadcaster thread
+	def wants(self, now):
+		if now < self.next_time:
+			return False
+		fps = self.fps
+		if self.rate and self.frame_size:
+			fps = min(fps, max(0.2, 0.8 * self.rate / self.frame_size))
+		# Keep to the schedule on average, without bursting after a gap
+		self.next_time = max(self.next_time + 1.0 / fps, now - 0.5 / fps)
+		return True
+
+	def put(self, data):
+		if isinstance(data, Exception):
+			self.loop.call_soon(self.handle_close)
+		else:
+			self.loop.call_soon(self._frame, data)
+
+	def _frame(self, data):
+		if self.busy():
+			if time.time() - self.last_progress > STREAM_TIMEOUT:
+				logging.info("Dropping stalled stream client")
+				self.handle_close()
+				return
+			self.good = 0
+			self.late += 1
+			self.late_frames.inc()
+			if self.late >= self.LATE_LIMIT and self.level < len(ADAPT_LEVELS) - 1:
+				self._set_level(self.level + 1)
+				self.late = 0
+		else:
+			self.late = 0
+			self.good += 1
+			if self.good >= self.GOOD_LIMIT and self.level > 0:
+				self._set_level(self.level - 1)
+				self.good = 0
+		self.push(data)
+
+	def message_sent(self, size, duration):
+		self.frame_size = size
+		rate = size / max(duration, 0.001)
+		if self.rate is None:
+			self.rate = rate
+		else:
+			self.rate = 0.7 * self.rate + 0.3 * rate
+
+	def _closed(self, channel):
+		self.broadcaster.unsubscribe(self)
+
+# Pushes named events to Server-Sent Events clients. The last message of each
+# event is kept and sent to new clients, so they start out with the current
+# state. publish() may be called from any thread.
+class EventHub(object):
+	KEEPALIVE = 15
+
+	def __init__(self, loop):
+		self.loop = loop
+		self.last = collections.OrderedDict()
+		self.clients = set()
+		EVENT_CLIENTS.set_function(lambda: len(self.clients))
+		self.loop.call_later(self.KEEPALIVE, self._keepalive)
+
+	# Messages replace earlier ones with the same key, the event name unless
+	# given, e.g. for events about different devices
+	def publish(self, event, data, key=None):
+		message = "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+		self.loop.call_soon(self._send, key or event, message)
+
+	# Loop thread only
+	def _send(self, key, message):
+		self.last[key] = message
+		for client in list(self.clients):
+			client.send_event(key, message)
+
+	def _keepalive(self):
+		for client in list(self.clients):
+			client.send_event(":", ": keepalive\n\n")
+		self.loop.call_later(self.KEEPALIVE, self._keepalive)
+
+	def attach(self, sock):
+		client = EventClient(self.loop, sock, self.clients.discard)
+		self.clients.add(client)
+		client.push("retry: 3000\n\n")
+		for event, message in self.last.items():
+			client.send_event(event, message)
+
+# Server-Sent Events client. Only the latest message of each event matters, so
+# messages that queue up behind a slow connection replace older ones.
+class EventClient(streamloop.StreamChannel):
+	def __init__(self, loop, sock, on_close):
+		streamloop.StreamChannel.__init__(self, loop, sock, on_close)
+		self.pending = collections.OrderedDict()
+
+	def send_event(self, key, message):
+		self.pending[key] = message
+		if not self.busy():
+			self._flush()
+
+	def _flush(self):
+		if self.pending:
+			data = "".join(self.pending.values())
+			self.pending.clear()
+			self.push(data)
+
+	def message_sent(self, size, duration):
+		self._flush()
+
+# A file served as is. It is loaded once and kept along with a gzipped copy
+# and an ETag, so that clients can revalidate instead of downloading it again.
+class StaticAsset(object):
+	def __init__(self, path, max_age=0):
+		with open(path, "rb") as fd:
+			self.data = fd.read()
+		self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+		if self.content_type.startswith("text/"):
+			self.content_type += "; charset=utf-8"
+		self.etag = '"%s"' % hashlib.sha1(self.data).hexdigest()[:16]
+		# Pages are revalidated on every load, other assets are cached for a while
+		if max_age:
+			self.cache_control = "max-age=%d" % max_age
+		else:
+			self.cache_control = "no-cache"
+		buf = StringIO.StringIO()
+		with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as fd:
+			fd.write(self.data)
+		self.gzipped = buf.getvalue()
+
+# URL path: (file under templates/, max age in seconds)
+STATIC = {
+	"/": ("index.html", 0),
+	"/jquery.js": ("jquery.js", 86400),
+}
+
+def load_assets():
+	return dict((url, StaticAsset(os.path.join("templates", name), max_age))
+	            for url, (name, max_age) in STATIC.items())
+
+# Short requests are handled in their own threads. Streaming clients are then
+# detached from their handler thread and served from the stream loop.
 class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
-	pass
+	daemon_threads = True
+
+	def __init__(self, server_address, handler):
+		BaseHTTPServer.HTTPServer.__init__(self, server_address, handler)
+		self.stream_loop = streamloop.StreamLoop()
+		self.events = EventHub(self.stream_loop)
+		self.detached = set()
+		self.detached_lock = threading.Lock()
+
+	# Hands sock over to the stream loop, which then calls attach(sock, *args)
+	def detach(self, sock, attach, *args):
+		with self.detached_lock:
+			self.detached.add(sock)
+		self.stream_loop.call_soon(attach, sock, *args)
+
+	# The broadcaster of a device's stream, the first device's by default, or
+	# None if there is no such device
+	def broadcaster(self, kind, device=None):
+		if device is None:
+			device = self.devices[0]
+		return self.broadcasters.get((int(device), kind))
+
+	def attach_stream(self, sock, broadcaster, **options):
+		self.detach(sock, self._attach, broadcaster, options)
+
+	def _attach(self, sock, broadcaster, options):
+		broadcaster.subscribe(MJPEGClient(self.stream_loop, sock, broadcaster, **options))
+
+	def attach_events(self, sock):
+		self.detach(sock, self.events.attach)
+
+	def shutdown_request(self, request):
+		with self.detached_lock:
+			if request in self.detached:
+				# Now owned by the stream loop
+				self.detached.discard(request)
+				return
+		BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+# /video and /depth streams, and their snapshots, of the first device, or of
+# device n under /video/<n>, /depth/<n> and /snapshot/<n>/
+STREAM_PATH = re.compile(r"^/(video|depth)(?:/(\d+))?$")
+SNAPSHOT_PATH = re.compile(r"^/snapshot/(?:(\d+)/)?(video|depth)\.jpg$")
 
 class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 	MIMETAG = "SW4gU292aWV0IFJ1c3NpYSwgQkFTRTY0IGRlY29kZXMgWU9VIQo="
 
-	STATIC = set([
-		"/jquery.js"
-	])
+	# Keep connections open between requests, for up to timeout seconds
+	protocol_version = "HTTP/1.1"
+	timeout = 30
+	# Buffer the headers, so that each response goes out in one piece
+	wbufsize = -1
 
 	def request_auth(self):
 		self.send_response(401, "You Shouldn't Be Here")
@@ -75,10 +481,36 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 			return False
 		return True
 
+	def stream_options(self, query):
+		# ?fps=N&size=WxH&quality=N, all optional
+		args = urlparse.parse_qs(query)
+		options = {}
+		try:
+			if "fps" in args:
+				options["fps"] = min(30.0, max(0.2, float(args["fps"][0])))
+			if "size" in args:
+				options["width"] = int(args["size"][0].split("x")[0])
+			if "quality" in args:
+				options["quality"] = int(args["quality"][0])
+		except ValueError:
+			return None
+		return options
+
 	def do_GET(self):
 		if not self.check_auth():
 			return
-		if self.path in ("/video", "/depth"):
+		parsed_path = urlparse.urlparse(self.path)
+		stream = STREAM_PATH.match(parsed_path.path)
+		snapshot = SNAPSHOT_PATH.match(parsed_path.path)
+		if stream:
+			broadcaster = self.server.broadcaster(*stream.groups())
+			if broadcaster is None:
+				self.send_error(404)
+				return
+			options = self.stream_options(parsed_path.query)
+			if options is None:
+				self.send_error(400)
+				return
 			self.send_response(200)
 			self.send_header("Connection", "Close")
 			self.send_header("Pragma", "no-cache")
@@ -86,38 +518,42 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 			self.send_header("Content-Type", "multipart/x-mixed-replace;boundary=" + self.MIMETAG)
 			self.end_headers()
 
-			if self.path == "/video":
-				stream = self.server.kinect.video_stream(15)
-			else:
-				stream = self.server.kinect.depth_stream(15)
+			self.wfile.flush()
+			self.server.attach_stream(self.connection, broadcaster, **options)
+		elif self.path == "/events":
+			self.send_response(200)
+			self.send_header("Connection", "Close")
+			self.send_header("Cache-Control", "no-cache")
+			self.send_header("Content-Type", "text/event-stream")
+			self.end_headers()
 
-			for frame in stream:
-				if self.path == "/video":
-					im = self.video_to_image(frame)
-				else:
-					im = self.depth_to_image(frame)
-				fd = StringIO.StringIO()
-				im.save(fd, "JPEG", quality=75)
-				data = fd.getvalue()
-				self.wfile.write("--" + self.MIMETAG + "\r\n")
-				self.send_header("Content-Type", "image/jpeg")
-				self.send_header("Content-Length", str(len(data)))
-				self.end_headers()
-				self.wfile.write(data)
-				self.wfile.flush()
-				if not self.server.keep_running:
-					break
-		elif self.path == "/":
-			self.send_html(self.template("index.html"))
+			self.wfile.flush()
+			self.server.attach_events(self.connection)
+		elif snapshot:
+			device, kind = snapshot.groups()
+			broadcaster = self.server.broadcaster(kind, device)
+			if broadcaster is None:
+				self.send_error(404)
+				return
+			data = broadcaster.snapshot()
+			if data is None:
+				self.send_error(503)
+			else:
+				self.send_data(data, "image/jpeg")
+		elif self.path == "/metrics":
+			self.send_data(metrics.REGISTRY.render(), "text/plain; version=0.0.4")
+		elif self.path == "/devices":
+			self.send_data(json.dumps(self.server.devices), "application/json")
 		elif self.path == "/state":
 			self.send_text(self.server.controller.state.__name__.title())
 		elif self.path.startswith("/setstate?"):
-			parsed_path = urlparse.urlparse(self.path)
 			if parsed_path.query in self.server.controller.states:
 				self.server.controller.switch_state(parsed_path.query)
-		elif self.path in self.STATIC:
-			data = self.template(self.path[1:])
-			self.send_data(data, mimetypes.guess_type(self.path))
+			self.send_response(204)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+		elif self.path in self.server.assets:
+			self.send_asset(self.server.assets[self.path])
 		else:
 			self.send_error(404)
 
@@ -132,13 +568,11 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
 	def send_data(self, data, content_type):
 		self.send_response(200)
-		self.send_header("Connection", "Close")
-		self.send_header("Pragma", "no-cache")
-		self.send_header("Expires", "0")
+		self.send_header("Cache-Control", "no-cache")
 		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(data)))
 		self.end_headers()
 		self.wfile.write(data)
-		self.wfile.flush()
 
 	def send_html(self, html):
 		self.send_data(html, "text/html; charset=utf-8")
@@ -146,77 +580,72 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 	def send_text(self, text):
 		self.send_data(text, "text/plain; charset=utf-8")
 
-	def template(self, name):
-		with open("templates/" + name, "rb") as fd:
-			return fd.read()
-
-	def depth_to_image(self, frame):
-		frame = frame.astype(np.float)
-		np.clip(frame, 0, 1046.31, frame)
-		frame = 45 / (frame * -0.0030711016 + 3.3309495161) - 45
-		np.clip(frame, 0, 255, frame)
-		frame = frame.astype(np.uint8)
-		im = Image.fromstring("L", (frame.shape[1], frame.shape[0]), frame.tostring())
-		im = im.resize((480, 360), Image.BILINEAR)
-		im.putpalette(color_palette)
-		im = im.convert("RGB")
-		#im = ImageEnhance.Brightness(im).enhance(0.2)
-		#im = ImageEnhance.Contrast(im).enhance(7.0)
-		im = ImageEnhance.Sharpness(im).enhance(1)
-		return im
-
-	def video_to_image(self, frame):
-		im = Image.fromstring("RGB", (frame.shape[1], frame.shape[0]), frame.tostring())
-		im = ImageOps.equalize(im)
-		return im.resize((480, 360), Image.BILINEAR)
+	def send_asset(self, asset):
+		etags = [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]
+		if asset.etag in etags or "*" in etags:
+			self.send_response(304)
+			self.send_header("ETag", asset.etag)
+			self.send_header("Cache-Control", asset.cache_control)
+			self.end_headers()
+			return
+		data = asset.data
+		self.send_response(200)
+		if "gzip" in self.headers.get("Accept-Encoding", ""):
+			data = asset.gzipped
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Vary", "Accept-Encoding")
+		self.send_header("ETag", asset.etag)
+		self.send_header("Cache-Control", asset.cache_control)
+		self.send_header("Content-Type", asset.content_type)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
 
 class WebServer(threading.Thread):
-	def __init__(self, controller, kinect):
+	def __init__(self, controller, kinects):
 		threading.Thread.__init__(self, name="WebServer")
 		self.controller = controller
 		server_address = ('', WEB_PORT)
 		self.httpd = ThreadedHTTPServer(server_address, RequestHandler)
-		self.httpd.kinect = kinect
+		self.httpd.kinects = kinects
+		self.httpd.devices = [kinect.device for kinect in kinects]
+		self.httpd.broadcasters = {}
+		for kinect in kinects:
+			self.httpd.broadcasters.update({
+				(kinect.device, "video"): StreamBroadcaster(kinect, "video", render.render_video),
+				(kinect.device, "depth"): StreamBroadcaster(kinect, "depth", render.render_depth),
+			})
 		self.httpd.controller = controller
-		self.httpd.keep_running = True
+		self.httpd.assets = load_assets()
+		self.events = self.httpd.events
 
 	def run(self):
-		while self.httpd.keep_running:
-			try:
-				self.httpd.handle_request()
-			except select.error, e:
-				if e.args[0] == 4:
-					continue
-				else:
-					raise
+		self.httpd.stream_loop.start()
+		try:
+			self.httpd.serve_forever(poll_interval=0.5)
+		finally:
+			self.httpd.stream_loop.stop()
+			self.httpd.server_close()
 
 	def start(self):
 		if self.is_alive():
 			return
 		logging.info("Web server started")
-		self.httpd.keep_running = True
 		threading.Thread.start(self)
 
 	def stop(self):
 		if not self.is_alive():
 			return
-		logging.info("Web server stopped")
-		self.httpd.keep_running = False
-		# Make a fake request to trigger thread exit
-		try:
-			fd = urllib2.urlopen("http://localhost:%d/" % WEB_PORT)
-			fd.read()
-			fd.close()
-		except urllib2.HTTPError:
-			pass
+		self.httpd.shutdown()
 		self.join()
+		logging.info("Web server stopped")
 
 if __name__ == "__main__":
 	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 	kinect = kinectcore.KinectStreamer()
 	kinect.start()
 	try:
-		server = WebServer(None, kinect)
+		server = WebServer(None, [kinect])
 		server.run()
 	finally:
 		kinect.stop()